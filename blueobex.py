@@ -1,128 +1,248 @@
 
+import asyncio
+import concurrent.futures
 import logging
 import os
 import os.path
-from subprocess import Popen
-import multiprocessing as mp
+import re
+import subprocess
 import tempfile
-import time
+import threading
 
 import pyinotify
 
 # Logger for this module
 _LOGGER = logging.getLogger(__name__)
 
-# System command to start obexpushd
-OBEXPUSHD_CMD = ['obexpushd', '-B' '-I']
+# System command to start obexpushd on Bluetooth, in the foreground so it can be watched and stopped
+OBEXPUSHD_CMD = ['obexpushd', '-B', '-n']
+# Output of obexpushd once it listens
+READY_REGEX = re.compile(r'[Ll]istening')
+# Seconds to wait for obexpushd to say it's listening, it's assumed to be ready if it's still running then
+STARTUP_TIMEOUT = 2.0
+# Seconds a received file must stay closed before it's passed to the callback, so a file that's written
+# in several parts is only passed once it's complete
+DEBOUNCE = 0.1
+
+class ObexError(Exception):
+    """ obexpushd failed to start. """
 
 class InotifyHandler(pyinotify.ProcessEvent):
     def my_init(self, callback):
+        # callback(path, complete): complete is False while the file is being written
         self.callback = callback
-        
+
+    def process_IN_MODIFY(self, event):
+        if not event.dir:
+            self.callback(event.pathname, False)
+
     def process_IN_CLOSE_WRITE(self, event):
-        #print('Received CLOSE_WRITE')
         if not event.dir:
-            self.callback(event.pathname)
+            self.callback(event.pathname, True)
+
+    def process_IN_MOVED_TO(self, event):
+        if not event.dir:
+            self.callback(event.pathname, True)
 
 class BlueObex:
     """
     Wrapper around the obexpushd program.
     Manages the subprocess and calls event handlers as appropriate.
 
-    When debug mode is enabled obexpushd will have debug mode enabled and all output will be forwarded to
-    the top console.
+    Everything runs in an asyncio event loop: the readiness of obexpushd is read from its output and exit
+    status, and the directory it writes to is watched with inotify in the same loop. The callback is
+    called in the thread of the loop, see start().
     """
-    def __init__(self, callback):
+    def __init__(self, callback, debounce=DEBOUNCE):
         """
         Initialize an OBEXPush.
-        :param channel: Bluetooth channel to listen on
-        :param debug: enable/disable debug mode
+        :param callback: called with the path of each received file
+        :param debounce: seconds a file must stay unchanged before callback is called
         """
         # obexpushd subprocess
-        self.process = None
+        self.proc_obex = None
         # Callback which we will call when a new file is received
         self.callback = callback
+        self.debounce = debounce
         # Boolean for if started or not
         self.started = False
         # Boolean for if we're currently running
         self.running = False
         # Temp directory
         self.directory = None
-        # Services
-        self.proc_obex = None
-        self.proc_notify = None
+        # Event loop, and its thread if started in the background
+        self.loop = None
+        self.thread = None
+        self.watch_manager = None
+        self.notifier = None
+        # Reads the output of obexpushd
+        self._output_task = None
+        # Set to stop
+        self._stopped = None
+        # Files being written: {path: timer handle of the callback}
+        self._pending = {}
 
-    def start(self, async=True):
+    def start(self, background=True):
         """
         Start the obexpushd and watch for received files.
         Executes callback when a new file is received.
+        :param background: run in a thread and return once obexpushd is ready, callback is called in that
+                           thread. Otherwise run in this thread until stop() or Ctrl-C.
+        :return: True if obexpushd started
         """
-
         # We're only allowed to start once. If we already started then return false.
         if self.started:
             return False
         self.started = True
 
+        ready = concurrent.futures.Future()
+        if background:
+            self.thread = threading.Thread(target=self._run, args=(ready,), daemon=True)
+            self.thread.start()
+            error = ready.result()
+        else:
+            error = self._run(ready)
+        if error is not None:
+            print(error)
+            return False
+        return True
+
+    def _run(self, ready):
+        """ Run the event loop until stop(). Sets the future ready to None once started, or to the error. """
+        loop = asyncio.new_event_loop()
+        task = loop.create_task(self._serve(ready))
+        try:
+            loop.run_until_complete(task)
+        except KeyboardInterrupt:
+            task.cancel()
+            try:
+                loop.run_until_complete(task)
+            except asyncio.CancelledError:
+                pass
+            loop.run_until_complete(self._shutdown())
+        finally:
+            loop.close()
+        return ready.result() if ready.done() else None
+
+    async def _serve(self, ready):
+        try:
+            await self.start_async()
+        except Exception as e:
+            ready.set_result(e)
+            return
+        ready.set_result(None)
+        await self._stopped.wait()
+        await self._shutdown()
+
+    async def start_async(self):
+        """
+        Start obexpushd and watch for received files in the running event loop. Returns once obexpushd is
+        ready, stop it with stop_async().
+        :throws ObexError: if obexpushd failed to start
+        """
+        self.loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        self.running = True
         # Create the temp directory
         self.directory = tempfile.TemporaryDirectory(dir='.')
         _LOGGER.info('Starting in ' + self.directory.name)
-        
         try:
-            # Now start OBEX listener
-            self.proc_obex = Popen(OBEXPUSHD_CMD, cwd=self.directory.name)
-            # Wait to see if it started successfully
-            time.sleep(2)
-            if self.proc_obex.poll():
-                # If we got a non-None value, an error occured
-                raise Exception('obexpushd failed to start')
-            # Create the watch manager
+            # Watch first, so no file can be missed
             self.watch_manager = pyinotify.WatchManager()
             self.watch_manager.add_watch(self.directory.name,
-                    pyinotify.IN_CLOSE_WRITE)
-            # Let the system know we've started successfully
-            self.running = True
-            self.notifier = pyinotify.Notifier(self.watch_manager,
-                    InotifyHandler(callback=self.callback))
-            if async:
-                self.proc_notify = mp.Process(target=lambda: self.notifier.loop())
-                self.proc_notify.start()
-            else:
-                self.notifier.loop(daemonize=False)
-            return True
-        except KeyboardInterrupt:
-            self.running = True
-            self.stop()
-            return True
-        except BaseException as e:
-            print(e)
-            self.running = True
-            self.stop()
-            return False
+                    pyinotify.IN_MODIFY | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO)
+            self.notifier = pyinotify.AsyncioNotifier(self.watch_manager, self.loop,
+                    default_proc_fun=InotifyHandler(callback=self._file_event))
+            # Now start OBEX listener
+            self.proc_obex = await asyncio.create_subprocess_exec(*OBEXPUSHD_CMD, cwd=self.directory.name,
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            ready = self.loop.create_future()
+            self._output_task = self.loop.create_task(self._read_output(ready))
+            try:
+                await asyncio.wait_for(asyncio.shield(ready), STARTUP_TIMEOUT)
+            except asyncio.TimeoutError:
+                # Quiet but running
+                ready.cancel()
+                _LOGGER.info('obexpushd is still running after %.1f seconds' % STARTUP_TIMEOUT)
+        except BaseException:
+            await self._shutdown()
+            raise
+
+    async def _read_output(self, ready):
+        """ Log the output of obexpushd, resolve the future ready when it's listening or fail it if it exits. """
+        lines = []
+        async for line in self.proc_obex.stdout:
+            line = line.decode('utf-8', 'replace').rstrip()
+            _LOGGER.info('obexpushd: ' + line)
+            lines = lines[-4:] + [line]
+            if not ready.done() and READY_REGEX.search(line):
+                ready.set_result(None)
+        status = await self.proc_obex.wait()
+        if not ready.done():
+            ready.set_exception(ObexError('obexpushd failed to start (status %i): %s' % (status, ' '.join(lines))))
+        elif self.running:
+            _LOGGER.error('obexpushd exited with status %i' % status)
+
+    def _file_event(self, path, complete):
+        """ Debounce the inotify events of path: the callback is called once it's been closed for a while. """
+        handle = self._pending.pop(path, None)
+        if handle is not None:
+            handle.cancel()
+        if complete:
+            self._pending[path] = self.loop.call_later(self.debounce, self._received, path)
+
+    def _received(self, path):
+        del self._pending[path]
+        if os.path.exists(path):
+            try:
+                self.callback(path)
+            except Exception:
+                _LOGGER.exception('Callback failed for ' + path)
 
     def stop(self):
-        """ End the OBEXPush service. Only useful if it's being run in a separate thread/process. """
+        """ End the OBEXPush service. Only useful if it's being run in a separate thread. """
         if not self.running:
             return True
+        if self.thread is not None:
+            self.loop.call_soon_threadsafe(self._stopped.set)
+            self.thread.join()
+        elif self.loop is not None and self.loop.is_running():
+            self._stopped.set()
+        return True
+
+    async def stop_async(self):
+        """ End the OBEXPush service started with start_async(). """
+        await self._shutdown()
+
+    async def _shutdown(self):
+        """ Kill subprocess and stop stalking the directory. """
+        if not self.running:
+            return
         self.running = False
-        # Kill subprocess and stop stalking the directory
+        for handle in self._pending.values():
+            handle.cancel()
+        self._pending.clear()
         if self.notifier:
             self.notifier.stop()
-        if self.proc_obex:
+        if self.proc_obex and self.proc_obex.returncode is None:
             self.proc_obex.terminate()
-        if self.proc_notify:
-            self.proc_notify.terminate()
-        if self.watch_manager:
-            pass  # self.watch_manager.close()  # Apparently terminating proc_notify closes this already. 
+            try:
+                await asyncio.wait_for(self.proc_obex.wait(), 5)
+            except asyncio.TimeoutError:
+                self.proc_obex.kill()
+                await self.proc_obex.wait()
+        if self._output_task:
+            await self._output_task
         self.directory.cleanup()
 
 def test():
     # This is the callback for OBEXPush
-    def obex_callback(directory, filename):
-        print('Event ' + directory + ' : ' + filename)
+    def obex_callback(path):
+        print('Event ' + path)
     # OBEX Push daemon wrapper
     obexd = BlueObex(obex_callback)
     # And start the listener
-    obexd.start(async=False)
+    obexd.start(background=False)
 
 # If this is the main program, invoke main
 if __name__ == '__main__':
@@ -1,7 +1,7 @@
 #!/bin/bash
 # Run this to install all the prerequisites
 
-# We need pip3, obexpushd, and python3-pyocr
-sudo apt-get install python3-pip obexpushd python3-pyocr
+# We need pip3, obexpushd, python3-pyocr, and python3-numpy (only needed by SOPCode.eval_many)
+sudo apt-get install python3-pip obexpushd python3-pyocr python3-numpy
 # Now we can install lark-parser and pyinotify (these are installed globally)
 sudo pip3 install lark-parser pyinotify
@@ -1,8 +1,18 @@
 
+import time
+# Start of the program, for the startup time
+_START = time.perf_counter()
+
+import concurrent.futures.process
+import inspect
+import queue
 import sys
-import multiprocessing as mp
+import threading
 
 import sopvm
+import sopbdd
+import sopindex
+import soptable
 
 def valtoarray(val):
     return [str(int(x)) for x in val]
@@ -15,33 +25,46 @@ class ReplInterface:
         self.loop = True
 
         self.obex = None        # BlueObex reference
-        self.ocrhelper = None   # OCRHelper
-        self.bt_queue = None    # Process-safe queue for transferring data from worker process to main process
+        self.ocrpool = None     # OCRPool
+        self.ocr_results = None # Futures of the OCRResult of each received file, in order
+        self.ocr_warmup = []    # Futures of the OCR backend timings of each OCRPool worker
+        self.bt_thread = None   # Starts Bluetooth
+        self.index = None       # FingerprintIndex, opened by the first "analyze"
+        self.startup = None     # Seconds from the start of the program to the first prompt
 
     def start_ocr(self):
-        """ Start OCR and Bluetooth. This is optional. """
+        """
+        Start OCR and Bluetooth. This is optional. Both start in the background, so the prompt shows
+        right away: the OCR workers load the OCR tool, and obexpushd starts in another thread.
+        """
         import sopocr
-        import blueobex
 
-        self.bt_queue = mp.Queue()
-        self.ocrhelper = sopocr.OCRHelper()
-        self.obex = blueobex.BlueObex(lambda path: self._obex_callback(path))
+        self.ocr_results = queue.Queue()
+        self.ocrpool = sopocr.OCRPool()
+        self.ocr_warmup = self.ocrpool.warm()
+        self.bt_thread = threading.Thread(target=self._start_bluetooth, daemon=True)
+        self.bt_thread.start()
 
-        print('Starting Bluetooth')
-        self.obex.start()
-        print('Bluetooth running')
+    def _start_bluetooth(self):
+        import blueobex
+
+        obex = blueobex.BlueObex(lambda path: self._obex_callback(path))
+        if obex.start():
+            self.obex = obex
 
     def _obex_callback(self, path):
-        """ Callback for when we recieve a file over Bluetooth. """
-        self.bt_queue.put_nowait(path)
+        """
+        Callback for when we recieve a file over Bluetooth, called in the thread of BlueObex.
+        The file is recognized right away, while the REPL waits for commands.
+        """
+        self.ocr_results.put(self.ocrpool.submit(path))
 
-    def _process_text(self, text):
+    def _process_text(self, text, long_names=None):
         """
         Update self.equation by parsing text. Handles errors correctly.
         """
         try:
-            varids = sopvm.get_variables(text)
-            self.equation = sopvm.parse(text, varids)
+            self.equation = sopvm.parse(text, long_names=long_names)
         except sopvm.UnexpectedToken as e:
             token = e.token
             print('Error: Unexpected token %s at line %i, column %i' % (token, token.line, token.column))
@@ -50,17 +73,30 @@ class ReplInterface:
 
     def run(self):
         print("Welcome to the Boolean Equation Analyzer! To see all available commands, type \"help\".")
+        self.startup = time.perf_counter() - _START
         try:
             while self.loop:
-                comm = input("> ")
-                command = getattr(self, 'cmd_'+comm.lower(), None)
+                words = input("> ").split()
+                command = getattr(self, 'cmd_'+words[0].lower(), None) if words else None
                 if command is not None:
-                    command()
+                    try:
+                        inspect.signature(command).bind(*words[1:])
+                    except TypeError:
+                        print("Invalid arguments. Usage: " + command.__doc__)
+                        continue
+                    command(*words[1:])
                 else:
                     print("Sorry, that command was not found. Try typing \"help\" for a list of commands.")
         finally:
+            if self.bt_thread:
+                self.bt_thread.join()
             if self.obex:
                 self.obex.stop()
+            if self.ocrpool:
+                self.ocrpool.shutdown(wait=False)
+            if self.index:
+                self.index.close()
+            soptable.shutdown_pool()
             
     def cmd_help(self):
         """help \t\t Prints out this lovely set of commands"""
@@ -72,20 +108,43 @@ class ReplInterface:
             if attribute.startswith("cmd_"):
                 print(getattr(self, attribute).__doc__)
 
-    def cmd_text(self):
-        """text \t\t Allows you to enter your Boolean Equation by typing it here in the console"""
-        comm = input("Please input your Boolean Equation, using only letters of the English alphabet as variables: \n")
+    def cmd_text(self, names=None):
+        """text [--long-names|--short-names] \t Allows you to enter your Boolean Equation by typing it here in the console, names are words or single letters"""
+        modes = {None: None, '--long-names': True, '--short-names': False}
+        if names not in modes:
+            print("Unknown option " + names)
+            return
+        comm = input("Please input your Boolean Equation, using letters of the English alphabet as variables "
+                     "(or names like x17, separated by spaces): \n")
         # input("Please input your Boolean Equation in the form \"[variables]:[equation]\" (e.g., \"xyx:x+(y'z)\"")
-        self._process_text(comm)
+        self._process_text(comm, modes[names])
 
     def cmd_image(self):
         """image \t\t Allows you to enter your Boolean Equation by transmitting an image of it to the device"""
-        print("Send the image via Bluetooth.")
-        path = self.bt_queue.get()
+        if self.ocrpool is None:
+            print("OCR and Bluetooth aren't running.")
+            return
+        if self.obex is None and self.ocr_results.empty():
+            if self.bt_thread.is_alive():
+                print("Bluetooth is starting.")
+            else:
+                print("Bluetooth failed to start.")
+                return
+        if self.ocr_results.empty():
+            print("Send the image via Bluetooth.")
+        try:
+            result = self.ocr_results.get().result()
+        except concurrent.futures.process.BrokenProcessPool as e:
+            print("OCR stopped working: %s" % e)
+            return
         print("Received Bluetooth file.")
-        text = self.ocrhelper.process(path)
-        print("Processed image as \"%s\"." % text)
-        self._process_text(text)
+        if result.cached:
+            print("This image was recognized before.")
+        print("Processed image as \"%s\"." % result.text)
+        if result.error is not None:
+            print(result.error)
+        else:
+            self.equation = result.code
 
     def cmd_solve(self):
         """solve \t\t Solves the Boolean Equation using given input values"""
@@ -107,27 +166,162 @@ class ReplInterface:
         else:
             print("You must enter an equation with either \"text\" or \"image\" first. ")
 
-    def cmd_table(self):
-        """table \t\t Displays a truth table of the most recently entered Boolean Equation"""
+    def cmd_table(self, path=None, *options):
+        """table [file] [--format text|csv|jsonl|bits] [--engine vector|gray] \t Displays a truth table of the most recently entered Boolean Equation, or writes it to file"""
         if self.equation is not None:
+            options = list(options)
+            if path is not None and path.startswith('--'):
+                # Options without a file
+                options.insert(0, path)
+                path = None
+            fmt = 'text' if path is None else 'csv'
+            engine = 'vector'
+            while options:
+                option = options.pop(0)
+                if option.startswith('--format='):
+                    fmt = option.split('=', 1)[1]
+                elif option == '--format' and options:
+                    fmt = options.pop(0)
+                elif option.startswith('--engine='):
+                    engine = option.split('=', 1)[1]
+                elif option == '--engine' and options:
+                    engine = options.pop(0)
+                else:
+                    print("Unknown option " + option)
+                    return
+            if fmt not in soptable.FORMATS or (fmt == 'bits' and path is None):
+                print("Unknown format %s, use one of %s (bits needs a file)" % (fmt, ", ".join(soptable.FORMATS)))
+                return
+            if engine not in soptable.ENGINES:
+                print("Unknown engine %s, use one of %s" % (engine, ", ".join(soptable.ENGINES)))
+                return
 
-            varids = self.equation.inputs
-            row = [0 for i in range(len(varids))]
+            if path is None:
+                soptable.write_table(self.equation, sys.stdout, fmt, engine=engine)
+                print()
+            else:
+                try:
+                    rows = soptable.write_table(self.equation, path, fmt, engine=engine)
+                except OSError as e:
+                    print(e)
+                    return
+                print("Wrote %i rows to %s" % (rows, path))
+        else:
+            print("You must enter an equation with either \"text\" or \"image\" first. ")
 
-            for i in varids:
-                print(i, end="  ")
-            print(str(self.equation))
+    def cmd_sat(self):
+        """sat \t\t Checks if each output of the Boolean Equation can be 1, and shows input values that do it"""
+        if self.equation is not None:
+            try:
+                solutions = sopbdd.any_solution(self.equation)
+            except sopbdd.BDDLimitError as e:
+                print(e)
+                return
+            for n, solution in enumerate(solutions):
+                if solution is None:
+                    print("Output %i: never 1" % n)
+                else:
+                    values = " ".join("%s=%i" % (name, solution[name]) for name in self.equation.inputs)
+                    print("Output %i: 1 when %s" % (n, values))
+        else:
+            print("You must enter an equation with either \"text\" or \"image\" first. ")
 
-            for i in range(2**len(varids)):
-                for j in range(len(varids)):
-                    row[j] = int((i/(2**j))) % 2
-                val = self.equation.eval(row)
-                fullrow = [str(x) for x in row] + valtoarray(val)
-                print("  ".join(fullrow))
-            print()
+    def cmd_count(self):
+        """count \t\t Counts the rows of the truth table where each output is 1, without building it"""
+        if self.equation is not None:
+            rows = 2**len(self.equation.inputs)
+            try:
+                counts = sopbdd.count_solutions(self.equation)
+            except sopbdd.BDDLimitError as e:
+                print(e)
+                return
+            for n, count in enumerate(counts):
+                print("Output %i: %i of %i rows" % (n, count, rows))
+        else:
+            print("You must enter an equation with either \"text\" or \"image\" first. ")
+
+    def cmd_analyze(self):
+        """analyze \t Counts and minimizes the Boolean Equation, reusing the results of any equivalent equation analyzed before"""
+        if self.equation is not None:
+            if self.index is None:
+                self.index = sopindex.FingerprintIndex()
+            try:
+                results = self.index.analyze(self.equation)
+            except sopbdd.BDDLimitError as e:
+                print(e)
+                return
+            if results['cached']:
+                print("Found an equivalent equation in the index.")
+            rows = 2**len(self.equation.inputs)
+            for n, count in enumerate(results['counts']):
+                print("Output %i: %i of %i rows" % (n, count, rows))
+            if results['minimized'] is not None:
+                print("Minimized: " + results['minimized'])
         else:
             print("You must enter an equation with either \"text\" or \"image\" first. ")
 
+    def cmd_equiv(self):
+        """equiv \t\t Checks if another Boolean Equation is equivalent to the most recently entered one"""
+        if self.equation is not None:
+            comm = input("Please input the Boolean Equation to compare with: \n")
+            try:
+                # Long names if they're needed by either equation
+                other = sopvm.parse(comm, long_names=self.equation.inputs.long_names or None)
+            except sopvm.ParseError as e:
+                print(e)
+                return
+            try:
+                diff = sopbdd.counterexample(self.equation, other)
+            except sopbdd.BDDLimitError as e:
+                print(e)
+                return
+            if diff is None:
+                print("The equations are equivalent.")
+            elif diff[1] is None:
+                print("The equations don't have the same number of outputs.")
+            else:
+                values = " ".join("%s=%i" % (name, value) for name, value in sorted(diff[1].items()))
+                print("The equations are different: output %i differs when %s" % (diff[0], values))
+        else:
+            print("You must enter an equation with either \"text\" or \"image\" first. ")
+
+    def cmd_stats(self, action=None, path=None):
+        """stats [on|off|reset|json [file]] \t Shows where time goes in parse, compile, eval and table output, turns profiling on or off, or exports the counters as JSON"""
+        if action is None:
+            print(sopvm.STATS.report())
+            if self.startup is not None:
+                print("Prompt shown %.1f ms after start" % (self.startup * 1e3))
+            for n, future in enumerate(self.ocr_warmup):
+                if future.done() and future.exception() is None:
+                    print("OCR worker %i: " % n + ", ".join(
+                        "%s %.1f ms" % (phase, seconds * 1e3) for phase, seconds in future.result().items()))
+            cache = self.ocrpool.cache_info() if self.ocrpool else None
+            if cache is not None:
+                print("OCR cache: %i hits, %i misses, %i evictions, %i write errors, %i images in %.1f of %.1f MB" % (
+                    cache['hits'], cache['misses'], cache['evictions'], cache['errors'], cache['size'],
+                    cache['bytes'] / 2**20, cache['max_bytes'] / 2**20))
+        elif action == 'on':
+            sopvm.enable_stats()
+            print("Profiling is on.")
+        elif action == 'off':
+            sopvm.disable_stats()
+            print("Profiling is off.")
+        elif action == 'reset':
+            sopvm.STATS.reset()
+        elif action == 'json':
+            if path is None:
+                print(sopvm.STATS.to_json(indent=2))
+            else:
+                try:
+                    with open(path, 'w') as fp:
+                        fp.write(sopvm.STATS.to_json(indent=2) + '\n')
+                except OSError as e:
+                    print(e)
+                    return
+                print("Wrote stats to %s" % path)
+        else:
+            print("Invalid arguments. Usage: " + self.cmd_stats.__doc__)
+
     def cmd_quit(self):
         """quit \t\t Exits the program. """
         self.loop = False
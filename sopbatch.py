@@ -0,0 +1,264 @@
+import argparse
+import itertools
+import json
+import sys
+import time
+
+import sopvm
+import soptable
+
+# Vectors evaluated together in one bit-parallel pass, see evaluate()
+BATCH_SIZE = 4096
+# Largest table a record can ask for
+TABLE_MAX_VARS = 24
+# Rows of a table column converted to text at a time
+TABLE_CHUNK_ROWS = 1 << 16
+
+# Translations between 0/1 bytes and binary digits
+_TO_DIGITS = bytes.maketrans(b'\0\1', b'01')
+_FROM_DIGITS = bytes.maketrans(b'01', b'\0\1')
+# Valid characters of string vectors and valid values of list vectors (True and False are equal to 1 and 0)
+_DIGITS = frozenset('01')
+_VALUES = frozenset((0, 1))
+
+def _dense(code, vector):
+    """ Input vector as a sequence of 0/1 in input order. """
+    if isinstance(vector, dict):
+        return code.inputs.dense(vector)
+    if isinstance(vector, str):
+        return vector.encode('ascii').translate(_FROM_DIGITS)
+    if not isinstance(vector, (list, tuple)):
+        raise TypeError('Input vectors must be strings, lists or objects, not %s' % type(vector).__name__)
+    return vector
+
+def _columns(code, vectors, strings):
+    """ Bit vector of each input over vectors, bit r being the value in vectors[r]. strings is True if they're all str. """
+    nvars = len(code.inputs)
+    # map() and set() rather than loops, the vectors are checked at C speed
+    if strings:
+        if set(map(len, vectors)) != {nvars}:
+            raise ValueError('Input vectors must have %i digits' % nvars)
+        # int() would also take '_', '+' and spaces, which would shift the bits of the next vectors
+        if not set(''.join(vectors)) <= _DIGITS:
+            raise ValueError('Input vectors must be strings of 0 and 1')
+        # Transpose, then the first vector is the least significant bit
+        return [int(''.join(column)[::-1], 2) for column in zip(*vectors)]
+    rows = vectors
+    if set(map(type, vectors)) != {list}:
+        rows = [_dense(code, vector) for vector in vectors]
+    if set(map(len, rows)) != {nvars}:
+        raise ValueError('Input vectors must have %i values' % nvars)
+    # bytes() takes any value up to 255, and 48 and 49 would be read as digits. 1.0 equals 1 but
+    # makes bytes() fail, so it's caught below.
+    if not set(itertools.chain.from_iterable(rows)) <= _VALUES:
+        raise ValueError('Input values must be 0 or 1')
+    try:
+        return [int(bytes(column).translate(_TO_DIGITS)[::-1], 2) for column in zip(*rows)]
+    except (ValueError, TypeError):
+        raise ValueError('Input values must be 0 or 1')
+
+def evaluate(code, vectors):
+    """
+    Evaluate code on up to a few thousand input vectors in one bit-parallel pass, which is much faster
+    than calling SOPCode.eval() on each.
+    :param vectors: strings of 0 and 1 or lists of 0/1 or bools, in input order, or {name: bool} dicts
+    :return: the outputs of each vector, a string of 0 and 1 if every vector is a string, a tuple of 0/1
+        otherwise
+    :throws ValueError: if a vector doesn't have one 0/1 value per input
+    :throws TypeError: if a vector isn't a str, list or dict
+    """
+    count = len(vectors)
+    if not count:
+        return []
+    full = (1 << count) - 1
+    strings = set(map(type, vectors)) == {str}
+    masks = _columns(code, vectors, strings) if code.inputs else []
+    outputs = [format(column, '0%ib' % count)[::-1] for column in sopvm._eval_vector(code._code, masks, full)]
+    if not outputs:
+        return ['' if strings else ()] * count
+    if strings:
+        return list(map(''.join, zip(*outputs)))
+    return list(zip(*[column.encode('ascii').translate(_FROM_DIGITS) for column in outputs]))
+
+def _table_chunks(code, parallel=None):
+    """ Yield the truth table of code as JSON text: a list of one string of 0 and 1 per output, row r at index r. """
+    rows = 1 << len(code.inputs)
+    size = max(1, rows // 8)
+    step = min(rows, TABLE_CHUNK_ROWS)
+    yield '['
+    for n, column in enumerate(soptable.table(code, parallel)):
+        # Packed bytes, so slicing a chunk doesn't shift the whole big integer
+        data = column.to_bytes(size, 'little')
+        yield ',"' if n else '"'
+        for start in range(0, rows, step):
+            value = int.from_bytes(data[start // 8:(start + step + 7) // 8], 'little')
+            yield format(value & ((1 << step) - 1), '0%ib' % step)[::-1]
+        yield '"'
+    yield ']'
+
+def parse_record(record):
+    """
+    Returns the SOPCode of the equation of a record, see handle().
+    :throws ValueError: if the record has no equation or an invalid "long_names"
+    :throws sopvm.ParseError: if the equation is invalid
+    """
+    if not isinstance(record, dict) or not isinstance(record.get('equation'), str):
+        raise ValueError('Expected an object with an "equation"')
+    long_names = record.get('long_names')
+    if long_names is not None and not isinstance(long_names, bool):
+        raise ValueError('"long_names" must be true or false')
+    return sopvm.parse(record['equation'], long_names=long_names)
+
+def error_result(ident, message):
+    """ Returns the JSON line of a record that failed. """
+    return '{"id":%s,"error":%s}\n' % (json.dumps(ident), json.dumps(message))
+
+def handle(record, number=None, counts=None, parallel=None):
+    """
+    Process one batch record, yields the JSON text of the result in pieces so a large result is never
+    held whole. Records are dicts:
+        equation - equation text, compiled once and then taken from sopvm.PARSE_CACHE
+        long_names - optional, true to read names as words ("ready ack"), false for single letters,
+                   decided from the equation by default (see sopvm.parse())
+        inputs   - optional list of input vectors to evaluate, see evaluate()
+        table    - optional, true for the truth table
+        id       - optional, copied to the result, defaults to number
+    The result has the id, the input names and the outputs of each vector and/or the table (one string
+    of 0 and 1 per output). An invalid record gives {"id": ..., "error": message}.
+    :param counts: optional dict, counts['evaluations'] is increased by the number of vectors evaluated
+    :param parallel: passed to soptable.table()
+    """
+    ident = record.get('id', number) if isinstance(record, dict) else number
+    try:
+        code = parse_record(record)
+        vectors = record.get('inputs')
+        if vectors is not None and not isinstance(vectors, list):
+            raise ValueError('"inputs" must be a list of input vectors')
+        want_table = bool(record.get('table'))
+        if want_table and len(code.inputs) > TABLE_MAX_VARS:
+            raise ValueError('Tables are limited to %i inputs' % TABLE_MAX_VARS)
+        # Evaluate the first batch before anything is written, so a bad vector gives an error record
+        first = evaluate(code, vectors[:BATCH_SIZE]) if vectors else None
+    except (sopvm.ParseError, ValueError, KeyError, TypeError) as e:
+        yield error_result(ident, str(e))
+        return
+    yield '{"id":' + json.dumps(ident) + ',"names":' + json.dumps(list(code.inputs))
+    if vectors is not None:
+        yield ',"outputs":['
+        try:
+            for start in range(0, len(vectors), BATCH_SIZE):
+                batch = first if start == 0 else evaluate(code, vectors[start:start + BATCH_SIZE])
+                if counts is not None:
+                    counts['evaluations'] = counts.get('evaluations', 0) + len(batch)
+                yield (',' if start else '') + json.dumps(batch, separators=(',', ':'))[1:-1]
+        except (ValueError, KeyError, TypeError) as e:
+            # The results are already partly written, the error ends the record
+            yield '],"error":' + json.dumps(str(e)) + '}\n'
+            return
+        yield ']'
+    if want_table:
+        yield ',"table":'
+        for chunk in _table_chunks(code, parallel):
+            yield chunk
+    yield '}\n'
+
+def run(lines, out):
+    """
+    Process the JSON records of lines (one per line, blank lines are skipped) and write a result line
+    for each to the text file out. Returns the number of records and the number of vectors evaluated.
+    """
+    records = 0
+    counts = {'evaluations': 0}
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        records += 1
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            out.write(error_result(number, 'Invalid JSON: %s' % e))
+            continue
+        for chunk in handle(record, number, counts):
+            out.write(chunk)
+    return records, counts['evaluations']
+
+def _test_batch():
+    """ Check the results against SOPCode.eval() and SOPCode.table(). """
+    import io
+    import random
+
+    rand = random.Random(24)
+    for text in ["abc:ab+(b+c)'", "abcd:(a+b')(c'+d)'+a(b(c+d));aa';a+a'", "x1 x2 x3:x1 x2' + x3", "ab:a;b;a+b", "a:a'"]:
+        code = sopvm.parse(text)
+        nvars = len(code.inputs)
+        rows = [[rand.random() < 0.5 for _ in range(nvars)] for _ in range(100)]
+        expected = [tuple(map(int, code.eval(row))) for row in rows]
+        assert evaluate(code, rows) == expected, text
+        assert evaluate(code, [''.join(str(int(v)) for v in row) for row in rows]) == \
+            [''.join(map(str, outs)) for outs in expected], text
+        assert evaluate(code, [dict(zip(code.inputs, row)) for row in rows]) == expected, text
+    out = io.StringIO()
+    lines = [
+        '{"equation": "abc:ab+c", "inputs": ["110", "001", "000"], "id": "x"}',
+        '{"equation": "ab:a;b", "inputs": [[1, 0], {"b": true}], "table": true}',
+        '',
+        '{"equation": "ab:a+", "inputs": ["11"]}',
+        '{"equation": "ab:a", "inputs": ["111", 3]}',
+        'not json',
+        '{"equation": "ready ack", "inputs": ["11"], "long_names": true}',
+        '{"equation": "ready ack", "inputs": ["1101011"]}',
+    ]
+    assert run(lines, out) == (7, 7)
+    results = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert results[0] == {'id': 'x', 'names': ['a', 'b', 'c'], 'outputs': ['1', '1', '0']}
+    assert results[1] == {'id': 2, 'names': ['a', 'b'], 'outputs': [[1, 0], [0, 1]], 'table': ['0101', '0011']}
+    assert [result['id'] for result in results[2:5]] == [4, 5, 6] and all('error' in result for result in results[2:5])
+    assert results[5] == {'id': 7, 'names': ['ack', 'ready'], 'outputs': ['1']}
+    assert results[6] == {'id': 8, 'names': list('acdekry'), 'outputs': ['0']}
+    # Cells that int() or bytes() would take but aren't 0 or 1
+    code = sopvm.parse('ab:a')
+    for vectors in (['11', '_1', '11'], ['11', ' 1'], [[1, 1], [48, 1]], [[1, 1], [1, 2]], [[0, 1.0]], [['1', 0]]):
+        try:
+            evaluate(code, vectors)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(vectors)
+    # Tables larger than one chunk
+    code = sopvm.parse('abcdefghijklmnopq:ab+cd+q')
+    table = json.loads(''.join(_table_chunks(code)))
+    assert [int(column[::-1], 2) for column in table] == code.table()
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Evaluate Boolean equations in batch: reads one JSON record per '
+                                     'line, {"equation": ..., "inputs": [vectors...], "table": true}, and writes '
+                                     'one JSON result per line.')
+    parser.add_argument('input', nargs='?', default='-', help='file of records, standard input by default')
+    parser.add_argument('-o', '--output', default='-', help='file to write the results to, standard output by default')
+    parser.add_argument('--stats', action='store_true', help='print the throughput to standard error')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    infile = sys.stdin if args.input == '-' else open(args.input)
+    outfile = sys.stdout if args.output == '-' else open(args.output, 'w', buffering=1 << 20)
+    try:
+        records, evaluations = run(infile, outfile)
+    finally:
+        soptable.shutdown_pool()
+        if infile is not sys.stdin:
+            infile.close()
+        if outfile is not sys.stdout:
+            outfile.close()
+    if args.stats:
+        seconds = time.perf_counter() - start
+        cache = sopvm.PARSE_CACHE.info()
+        print('%i records, %i evaluations in %.3f s: %.0f evaluations/s, parse cache %i hits %i misses' % (
+            records, evaluations, seconds, evaluations / seconds if seconds else 0, cache['hits'], cache['misses']),
+            file=sys.stderr)
+    return 0
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--test']:
+        _test_batch()
+    else:
+        sys.exit(main(sys.argv[1:]))
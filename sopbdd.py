@@ -0,0 +1,339 @@
+import sopvm
+
+# Terminal nodes
+FALSE = 0
+TRUE = 1
+
+# Default limit on the number of nodes of a BDD manager. A node takes a few hundred bytes with its
+# entries in the caches, so this is a few hundred MB at most.
+MAX_NODES = 500000
+# Entries of the ite() cache kept for each node allowed, the cache is cleared when it has more
+CACHE_PER_NODE = 4
+
+class BDDLimitError(Exception):
+    """ The BDD of an equation has too many nodes, or too many variables, to be built. """
+
+class BDD:
+    """
+    Reduced ordered binary decision diagram manager.
+    Nodes are integers, FALSE and TRUE are the terminals. Every node is unique so two functions are
+    equivalent exactly when they're the same node.
+    Variables are ordered by the order they are first declared in.
+    Some functions have BDDs exponential in the number of variables whatever the order, building one
+    raises BDDLimitError once the manager has more than max_nodes nodes.
+    """
+    def __init__(self, max_nodes=MAX_NODES):
+        """
+        Initialize a BDD manager.
+        :param max_nodes: largest number of nodes, None for no limit
+        """
+        self.max_nodes = max_nodes
+        self._level = [None, None]  # Variable level of each node, None for terminals
+        self._lo = [FALSE, TRUE]    # Node for variable = False
+        self._hi = [FALSE, TRUE]    # Node for variable = True
+        self._unique = {}           # (level, lo, hi) -> node
+        self._cache = {}            # (f, g, h) -> ite(f, g, h)
+        self.names = []             # Variable name of each level
+        self._levels = {}           # Variable name -> level
+
+    def __len__(self):
+        """ Number of nodes, including the terminals. """
+        return len(self._level)
+
+    def declare(self, name):
+        """ Returns the level of variable name, adding it at the bottom of the order if it's new. """
+        level = self._levels.get(name)
+        if level is None:
+            level = self._levels[name] = len(self.names)
+            self.names.append(name)
+        return level
+
+    def var(self, name):
+        """ Returns the node of variable name. """
+        return self._mk(self.declare(name), FALSE, TRUE)
+
+    def _mk(self, level, lo, hi):
+        """ Returns the unique node for (level, lo, hi). """
+        if lo == hi:
+            return lo
+        key = (level, lo, hi)
+        node = self._unique.get(key)
+        if node is None:
+            if self.max_nodes is not None and len(self._level) >= self.max_nodes:
+                raise BDDLimitError('The BDD has more than %i nodes' % self.max_nodes)
+            node = self._unique[key] = len(self._level)
+            self._level.append(level)
+            self._lo.append(lo)
+            self._hi.append(hi)
+        return node
+
+    def _top(self, node):
+        """ Level of a node, terminals are below every variable. """
+        level = self._level[node]
+        return len(self.names) if level is None else level
+
+    def ite(self, f, g, h):
+        """ Returns the node for "if f then g else h". """
+        if f == TRUE:
+            return g
+        if f == FALSE:
+            return h
+        if g == h:
+            return g
+        if g == TRUE and h == FALSE:
+            return f
+        key = (f, g, h)
+        node = self._cache.get(key)
+        if node is not None:
+            return node
+        top = min(self._top(f), self._top(g), self._top(h))
+        cof = []
+        for x in (f, g, h):
+            if self._level[x] == top:
+                cof.append((self._lo[x], self._hi[x]))
+            else:
+                cof.append((x, x))
+        lo = self.ite(cof[0][0], cof[1][0], cof[2][0])
+        hi = self.ite(cof[0][1], cof[1][1], cof[2][1])
+        node = self._mk(top, lo, hi)
+        if self.max_nodes is not None and len(self._cache) >= CACHE_PER_NODE * self.max_nodes:
+            # It's only a cache, keep its memory in proportion to the node limit
+            self._cache.clear()
+        self._cache[key] = node
+        return node
+
+    def apply_and(self, f, g):
+        return self.ite(f, g, FALSE)
+
+    def apply_or(self, f, g):
+        return self.ite(f, TRUE, g)
+
+    def apply_not(self, f):
+        return self.ite(f, FALSE, TRUE)
+
+    def apply_xor(self, f, g):
+        return self.ite(f, self.apply_not(g), g)
+
+    def build(self, text, inputs=None, long_names=None):
+        """
+        Build the nodes of every output of an equation. Returns a list of nodes.
+        :param text: equation text, same as sopvm.parse()
+        :param inputs: names to declare first, in this order, may be None
+        :param long_names: use the long names grammar, None to decide with sopvm.uses_long_names()
+        :throws sopvm.ParseError: if text is not a valid equation
+        :throws BDDLimitError: if the BDD is too large
+        """
+        if long_names is None:
+            long_names = sopvm.uses_long_names(text, inputs)
+        for name in inputs or ():
+            self.declare(name)
+        return self.build_code(sopvm.parse(text, long_names=long_names))
+
+    def build_code(self, sopcode):
+        """
+        Build the nodes of every output of a SOPCode by running its bytecode on BDD nodes instead of
+        bools. The bytecode has no recursion, so neither has this, whatever the nesting of the equation.
+        Returns a list of nodes.
+        :throws BDDLimitError: if the BDD is too large
+        """
+        # Declare the variables first so the BDD uses the same order as the truth table
+        variables = [self.var(name) for name in sopcode.inputs]
+        code = sopcode._code
+        acc = FALSE     # OR of the finished product terms of the current group
+        v = TRUE        # Current product term
+        stack = []      # (acc, v) of the enclosing groups
+        temps = {}      # Temporary slots
+        outputs = []
+        try:
+            for pos in range(0, len(code), 2):
+                op, arg = code[pos], code[pos + 1]
+                if op == sopvm.OP_AND:
+                    v = self.apply_and(v, variables[arg])
+                elif op == sopvm.OP_NAND:
+                    v = self.apply_and(v, self.apply_not(variables[arg]))
+                elif op == sopvm.OP_OR:
+                    # Both branches of the short-circuit, so the jump is not taken
+                    acc = self.apply_or(acc, v)
+                    v = TRUE
+                elif op == sopvm.OP_PUSH:
+                    stack.append((acc, v))
+                    acc, v = FALSE, TRUE
+                elif op == sopvm.OP_POP:
+                    group = self.apply_or(acc, v)
+                    if arg:
+                        group = self.apply_not(group)
+                    acc, v = stack.pop()
+                    v = self.apply_and(v, group)
+                elif op == sopvm.OP_LOAD:
+                    v = self.apply_and(v, temps[arg])
+                elif op == sopvm.OP_LOADN:
+                    v = self.apply_and(v, self.apply_not(temps[arg]))
+                elif op == sopvm.OP_OUT:
+                    outputs.append(self.apply_or(acc, v))
+                    acc, v = FALSE, TRUE
+                elif op == sopvm.OP_STORE:
+                    temps[arg] = self.apply_or(acc, v)
+                    acc, v = FALSE, TRUE
+                # OP_JF only skips literals once the term is already false, it changes nothing here
+        except RecursionError:
+            # ite() recurses once per variable
+            raise BDDLimitError('The BDD has too many variables (%i)' % len(self.names))
+        return outputs
+
+    def count(self, f, nvars=None):
+        """
+        Returns the number of assignments of the variables that make f True.
+        :param nvars: count over the first nvars declared variables, defaults to all of them
+        """
+        if nvars is None:
+            nvars = len(self.names)
+        memo = {FALSE: 0, TRUE: 1}
+
+        def level(node):
+            lvl = self._level[node]
+            return nvars if lvl is None else lvl
+
+        def count(node):
+            if node in memo:
+                return memo[node]
+            lvl = level(node)
+            lo, hi = self._lo[node], self._hi[node]
+            total = (count(lo) << (level(lo) - lvl - 1)) + (count(hi) << (level(hi) - lvl - 1))
+            memo[node] = total
+            return total
+
+        try:
+            return count(f) << level(f)
+        except RecursionError:
+            raise BDDLimitError('The BDD has too many variables (%i)' % len(self.names))
+
+    def support(self, nodes):
+        """ Returns the set of the names of the variables the functions nodes depend on. """
+        names = set()
+        seen = set([FALSE, TRUE])
+        pending = list(nodes)
+        while pending:
+            node = pending.pop()
+            if node in seen:
+                continue
+            seen.add(node)
+            names.add(self.names[self._level[node]])
+            pending.append(self._lo[node])
+            pending.append(self._hi[node])
+        return names
+
+    def signature(self, nodes):
+        """
+        Returns a canonical serialization of the functions nodes as bytes. Nodes are numbered in depth
+        first order, so two managers that declared the variables in the same order give the same bytes
+        for the same functions, whatever order the nodes were created in.
+        """
+        ids = {FALSE: 0, TRUE: 1}
+        lines = []
+        for root in nodes:
+            pending = [root]
+            while pending:
+                node = pending[-1]
+                if node in ids:
+                    pending.pop()
+                    continue
+                lo, hi = self._lo[node], self._hi[node]
+                children = [child for child in (hi, lo) if child not in ids]
+                if children:
+                    pending.extend(children)
+                    continue
+                pending.pop()
+                ids[node] = len(ids)
+                lines.append('%s %i %i' % (self.names[self._level[node]], ids[lo], ids[hi]))
+            lines.append('= %i' % ids[root])
+        return '\n'.join(lines).encode('utf-8')
+
+    def solution(self, f):
+        """ Returns a {name: bool} assignment that makes f True, or None if f is unsatisfiable. """
+        if f == FALSE:
+            return None
+        assignment = dict((name, False) for name in self.names)
+        while f != TRUE:
+            name = self.names[self._level[f]]
+            if self._lo[f] != FALSE:
+                f = self._lo[f]
+            else:
+                assignment[name] = True
+                f = self._hi[f]
+        return assignment
+
+def _build(sopcode, bdd=None):
+    """ Build the output nodes of a SOPCode, in a new manager unless bdd is given. """
+    if bdd is None:
+        bdd = BDD()
+    return bdd, bdd.build_code(sopcode)
+
+def is_equivalent(a, b):
+    """ Returns True if the SOPCodes a and b compute the same function for every output. """
+    bdd, fa = _build(a)
+    _, fb = _build(b, bdd)
+    return fa == fb
+
+def counterexample(a, b):
+    """
+    Returns (output index, {name: bool}) for an assignment where a and b differ, or None if they're
+    equivalent. If they don't have the same number of outputs the assignment is None.
+    """
+    bdd, fa = _build(a)
+    _, fb = _build(b, bdd)
+    if len(fa) != len(fb):
+        return (min(len(fa), len(fb)), None)
+    for n, (x, y) in enumerate(zip(fa, fb)):
+        if x != y:
+            return (n, bdd.solution(bdd.apply_xor(x, y)))
+    return None
+
+def is_satisfiable(sopcode):
+    """ Returns a list of bools, True for each output that can be True. """
+    _, outputs = _build(sopcode)
+    return [f != FALSE for f in outputs]
+
+def count_solutions(sopcode):
+    """ Returns the number of input assignments that make each output True. """
+    bdd, outputs = _build(sopcode)
+    return [bdd.count(f, len(sopcode.inputs)) for f in outputs]
+
+def any_solution(sopcode):
+    """ Returns a {name: bool} assignment that makes each output True, None if there isn't one. """
+    bdd, outputs = _build(sopcode)
+    return [bdd.solution(f) for f in outputs]
+
+def _test_bdd():
+    """ Check the BDD against the truth table. """
+    TESTS = [
+        "abc:ab+(b+c)'",
+        "abcd:(a+b')(c'+d)'+a(b(c+d));aa';a+a'",
+        "ab:ab;a+b;a'b",
+    ]
+    for expr in TESTS:
+        code = sopvm.parse(expr)
+        rows = 2**len(code.inputs)
+        counts = [bin(col).count('1') for col in code.table()]
+        assert count_solutions(code) == counts, (expr, count_solutions(code), counts)
+        assert is_satisfiable(code) == [c > 0 for c in counts]
+        for n, sol in enumerate(any_solution(code)):
+            if sol is not None:
+                assert code.eval([sol[name] for name in code.inputs])[n]
+        assert is_equivalent(code, sopvm.minimize(code))
+        print('%s: %s of %i rows' % (expr, counts, rows))
+    assert not is_equivalent(sopvm.parse("ab:a+b"), sopvm.parse("ab:ab"))
+    print(counterexample(sopvm.parse("ab:a+b"), sopvm.parse("ab:ab")))
+    # Deep nesting is fine, a BDD larger than the limit is an error
+    deep = sopvm.parse('a' + '(b+' * 5000 + 'c' + ')' * 5000)
+    assert count_solutions(deep) == [bin(col).count('1') for col in deep.table()]
+    bdd = BDD(max_nodes=10)
+    try:
+        bdd.build("abcdefgh:ab'+cd+ef'+gh;ah+bg+cf+de")
+    except BDDLimitError as e:
+        print(e)
+    else:
+        raise AssertionError('no BDDLimitError')
+    assert len(bdd) <= 10
+
+if __name__ == '__main__':
+    _test_bdd()
@@ -0,0 +1,247 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import lark
+
+import sopvm
+import soptable
+
+STAGES = ('parse', 'eval', 'table', 'ocr')
+# Equations written on the generated OCR images
+IMAGE_EQUATIONS = ["ab:ab+a'b", "abc:a(b+c)'", "abcd:ab+cd;a'b'", "xyz:x'y+(y+z)'x"]
+
+def random_sop(rand, nvars, terms, literals=3):
+    """ Random sum of products over the first nvars letters, each term has up to literals literals. """
+    letters = sopvm.SymbolTable.intern('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'[:nvars])
+    return str(letters) + ':' + '+'.join(
+        ''.join(rand.choice((v, v + "'")) for v in rand.sample(letters.names, min(literals, nvars)))
+        for _ in range(terms))
+
+def nested(depth):
+    """ Equation nested depth parentheses deep, alternating c(d+...) and a(b'+...). """
+    return 'abcd:' + ''.join("a(b'+" if n % 2 else "c(d+" for n in range(depth)) + 'a' + ')' * depth
+
+def multi_output(rand, nvars, outputs, pool=8):
+    """ Multi-output program where every output is an OR of terms picked from a shared pool. """
+    letters = 'abcdefghijklmnopqrstuvwxyz'[:nvars]
+    shared = [''.join(rand.choice((v, v + "'")) for v in rand.sample(letters, 4)) for _ in range(pool)]
+    shared += ['(%s+%s)' % tuple(rand.sample(letters, 2)) + rand.choice(letters) for _ in range(pool // 2)]
+    return letters + ':' + ';'.join('+'.join(rand.sample(shared, 4)) for _ in range(outputs))
+
+def workloads(quick=False):
+    """ Returns the list of (name, params, equation text) to benchmark. """
+    rand = random.Random(240)
+    out = []
+    for nvars in ((4, 12) if quick else (4, 8, 12, 16, 20)):
+        for terms in ((10, 100) if quick else (10, 100, 1000)):
+            out.append(('random', {'vars': nvars, 'terms': terms}, random_sop(rand, nvars, terms)))
+    for depth in ((10, 100) if quick else (10, 100, 1000)):
+        out.append(('nested', {'depth': depth}, nested(depth)))
+    for outputs in ((4, 16) if quick else (4, 16, 64)):
+        out.append(('multi', {'vars': 12, 'outputs': outputs}, multi_output(rand, 12, outputs)))
+    return out
+
+def measure(func, repeat, number=1):
+    """ Run func number times per sample, returns the list of seconds per call of each sample. """
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        samples.append((time.perf_counter() - start) / number)
+    return samples
+
+def result(workload, stage, params, samples, items=1):
+    """ Build one result record. items is the number of rows or evaluations done per call. """
+    return {
+        'workload': workload,
+        'stage': stage,
+        'params': params,
+        'min': min(samples),
+        'median': statistics.median(samples),
+        'items': items,
+        'us_per_item': min(samples) / items * 1e6,
+    }
+
+def bench_equations(stages, repeat, quick=False, log=None):
+    """ Benchmark the parse, eval and table stages on the generated workloads. Returns the results. """
+    results = []
+    for workload, params, text in workloads(quick):
+        if log:
+            log('%s %s' % (workload, params))
+        # Multi-output programs are compiled with common subexpression elimination
+        cse = workload == 'multi'
+        code = sopvm.parse(text, cache=False, cse=cse)
+        if 'parse' in stages:
+            samples = measure(lambda: sopvm.parse(text, cache=False, cse=cse), repeat)
+            results.append(result(workload, 'parse', params, samples))
+        if 'eval' in stages:
+            nvars = len(code.inputs)
+            rand = random.Random(0)
+            rows = [[rand.random() < 0.5 for _ in range(nvars)] for _ in range(1000)]
+            code.eval(rows[0])
+
+            def run():
+                for row in rows:
+                    code.eval(row)
+            results.append(result(workload, 'eval', params, measure(run, repeat), len(rows)))
+        if 'table' in stages and len(code.inputs) <= 20:
+            samples = measure(lambda: soptable.table(code, parallel=False), repeat)
+            results.append(result(workload, 'table', params, samples, 2**len(code.inputs)))
+    return results
+
+def make_images(path):
+    """ Draw IMAGE_EQUATIONS as black text on white PNG files in directory path. Returns the file names. """
+    from PIL import Image, ImageDraw, ImageFont
+
+    try:
+        font = ImageFont.truetype('DejaVuSans.ttf', 64)
+    except OSError:
+        font = ImageFont.load_default()
+    files = []
+    for n, text in enumerate(IMAGE_EQUATIONS):
+        image = Image.new('L', (1600, 400), 255)
+        ImageDraw.Draw(image).text((100, 150), text, fill=0, font=font)
+        name = os.path.join(path, 'equation%i.png' % n)
+        image.save(name)
+        files.append(name)
+    return files
+
+def bench_ocr(repeat, images=None, log=None):
+    """
+    Benchmark OCRHelper.process() with and without preprocessing on the images in directory images, or
+    on generated images, whose results are also checked against IMAGE_EQUATIONS.
+    Returns the results, empty if PIL, pyocr or Tesseract aren't available.
+    """
+    import sopocr
+
+    try:
+        sopocr.ocr_tool()
+    except sopocr.OCRError as e:
+        if log:
+            log('Skipping OCR: %s' % e)
+        return []
+    tmp = None
+    try:
+        if images is None:
+            tmp = tempfile.mkdtemp()
+            files = make_images(tmp)
+            expected = IMAGE_EQUATIONS
+        else:
+            files = sorted(os.path.join(images, f) for f in os.listdir(images)
+                           if os.path.splitext(f)[1].lower() in sopocr.VALID_IMAGE_EXTENSIONS)
+            expected = [None] * len(files)
+        results = []
+        for preprocess in (False, True):
+            helper = sopocr.OCRHelper(preprocess=preprocess)
+            for name, equation in zip(files, expected):
+                if log:
+                    log('ocr %s preprocess=%s' % (os.path.basename(name), preprocess))
+                # process() prints the file name, keep it out of the output
+                with contextlib.redirect_stdout(io.StringIO()):
+                    samples = measure(lambda: helper.process(name), repeat)
+                    recognized = helper.recognize(name)
+                record = result('image', 'ocr', {'file': os.path.basename(name), 'preprocess': preprocess}, samples)
+                record['valid'] = recognized.error is None
+                if equation is not None:
+                    record['correct'] = recognized.text.replace(' ', '') == equation
+                record['stages'] = dict(helper.timings)
+                results.append(record)
+        return results
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp)
+
+def run(stages=STAGES, repeat=5, quick=False, images=None, log=None):
+    """ Run the benchmarks, returns the results document. """
+    results = bench_equations(stages, repeat, quick, log)
+    if 'ocr' in stages:
+        results += bench_ocr(max(1, repeat // 2), images, log)
+    return {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'lark': getattr(lark, '__version__', ''),
+            'cpus': os.cpu_count(),
+            'repeat': repeat,
+            'quick': quick,
+        },
+        'results': results,
+    }
+
+def _key(record):
+    return (record['workload'], record['stage'], json.dumps(record['params'], sort_keys=True))
+
+def compare(old, new, threshold=0.1):
+    """
+    Compare two results documents. Returns (lines of text, number of regressions), a regression being
+    a result more than threshold slower (by its minimum time) than the same result in old.
+    """
+    before = dict((_key(r), r) for r in old['results'])
+    lines = []
+    regressions = 0
+    for record in new['results']:
+        base = before.get(_key(record))
+        if base is None:
+            continue
+        ratio = record['min'] / base['min'] if base['min'] else 1.0
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        elif ratio < 1 - threshold:
+            flag = '  faster'
+        lines.append('%-7s %-6s %-40s %10.3f ms -> %10.3f ms  x%.2f%s' % (
+            record['workload'], record['stage'], json.dumps(record['params'], sort_keys=True),
+            base['min'] * 1e3, record['min'] * 1e3, ratio, flag))
+    return lines, regressions
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark parse, eval, truth table and OCR.')
+    parser.add_argument('--quick', action='store_true', help='smaller workloads')
+    parser.add_argument('--repeat', type=int, default=5, help='samples per measurement, the minimum is kept')
+    parser.add_argument('--stages', default=','.join(STAGES), help='comma separated stages to run')
+    parser.add_argument('--images', help='directory of equation images for the OCR stage, generated by default')
+    parser.add_argument('--out', help='write the results to this JSON file instead of stdout')
+    parser.add_argument('--compare', help='results JSON file of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='slowdown reported as a regression')
+    args = parser.parse_args(argv)
+
+    stages = args.stages.split(',')
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error('unknown stage %s, use %s' % (stage, ','.join(STAGES)))
+
+    def log(message):
+        print(message, file=sys.stderr)
+
+    doc = run(stages, args.repeat, args.quick, args.images, log)
+    text = json.dumps(doc, indent=2)
+    if args.out:
+        with open(args.out, 'w') as fp:
+            fp.write(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as fp:
+            old = json.load(fp)
+        lines, regressions = compare(old, doc, args.threshold)
+        for line in lines:
+            log(line)
+        log('%i regressions' % regressions)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,138 @@
+import dbm
+import json
+import os
+
+import sopbdd
+import sopvm
+
+# Default location of the index
+INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sopindex.db')
+
+def analyze(code):
+    """
+    Compute the analysis results of a SOPCode that only depend on the function it computes, so they can
+    be shared by every equivalent equation. Results are over the support of the function (see
+    SOPCode.support()) and are converted back to a given equation by FingerprintIndex.analyze().
+    Returns a dict that can be stored as JSON:
+        support   - names of the inputs the outputs depend on, sorted
+        counts    - number of rows over the support where each output is 1
+        minimized - minimized outputs without the prefix, None if there are too many inputs
+    :throws sopbdd.BDDLimitError: if the BDD of code is too large
+    """
+    support = code.support()
+    extra = len(code.inputs) - len(support)
+    counts = [count >> extra for count in sopbdd.count_solutions(code)]
+    try:
+        minimized = sopvm.minimize(code).text.split(':', 1)[1]
+    except ValueError:
+        minimized = None
+    return {'support': list(support), 'counts': counts, 'minimized': minimized}
+
+class FingerprintIndex:
+    """
+    Persistent map of SOPCode.fingerprint() to analysis results (see analyze()), so an equation that
+    computes the same function as one seen before, however it's written, is answered without being
+    analyzed again. Stored in a dbm hash file, values are JSON.
+    """
+    def __init__(self, path=INDEX_PATH):
+        """
+        Open or create an index.
+        :param path: file name of the index, dbm may add an extension
+        """
+        self.path = path
+        self._db = dbm.open(path, 'c')
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self._db)
+
+    def __contains__(self, code):
+        return code.fingerprint().encode('ascii') in self._db
+
+    def close(self):
+        """ Write the index and close it. """
+        self._db.close()
+
+    def get(self, code):
+        """ Returns the stored results for the function of code, None if it's not in the index. """
+        data = self._db.get(code.fingerprint().encode('ascii'))
+        return None if data is None else json.loads(data.decode('utf-8'))
+
+    def put(self, code, results):
+        """ Store results for the function of code. """
+        self._db[code.fingerprint().encode('ascii')] = json.dumps(results).encode('utf-8')
+
+    def analyze(self, code):
+        """
+        Returns the analysis results for code, from the index if an equivalent equation was analyzed
+        before. Counts are over every input of code, and the minimized equation uses its prefix:
+            cached      - True if the results came from the index
+            counts      - number of truth table rows where each output is 1
+            satisfiable - True for each output that can be 1
+            minimized   - minimized equation, None if there are too many inputs
+        :throws sopbdd.BDDLimitError: if the BDD of code is too large
+        """
+        key = code.fingerprint().encode('ascii')
+        data = self._db.get(key)
+        cached = data is not None
+        if cached:
+            self.hits += 1
+            results = json.loads(data.decode('utf-8'))
+        else:
+            self.misses += 1
+            results = analyze(code)
+            self._db[key] = json.dumps(results).encode('utf-8')
+        extra = len(code.inputs) - len(results['support'])
+        minimized = results['minimized']
+        if minimized is not None:
+            # Constant outputs have the same fingerprint whatever the names, so they're written again
+            # with the inputs of code rather than those of the equation that was analyzed
+            rows = 1 << len(results['support'])
+            minimized = ';'.join(
+                sopvm.constant_text(count == rows, code.inputs) if count in (0, rows) else text
+                for count, text in zip(results['counts'], minimized.split(';')))
+        return {
+            'cached': cached,
+            'counts': [count << extra for count in results['counts']],
+            'satisfiable': [count > 0 for count in results['counts']],
+            'minimized': None if minimized is None else str(code.inputs) + ':' + minimized,
+        }
+
+    def info(self):
+        """ Returns the statistics as a dict. """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._db)}
+
+def _test_index():
+    """ Check that equivalent equations share one entry. """
+    import shutil
+    import tempfile
+
+    tmp = tempfile.mkdtemp()
+    try:
+        with FingerprintIndex(os.path.join(tmp, 'index')) as index:
+            first = index.analyze(sopvm.parse("abc:ab+ab'+cc'"))
+            print(first)
+            assert not first['cached'] and first['counts'] == [4]
+            second = index.analyze(sopvm.parse("ba:a"))
+            print(second)
+            assert second['cached'] and second['counts'] == [2] and second['minimized'] == 'ba:a'
+            assert not index.analyze(sopvm.parse("ab:b"))['cached']
+            print(index.info())
+            # Constant outputs use the names of the equation they're asked for
+            assert index.analyze(sopvm.parse("ab:aa';b+b'"))['minimized'] == "ab:aa';a+a'"
+            constant = index.analyze(sopvm.parse("zy:zz';y+y'"))
+            assert constant['cached'] and constant['minimized'] == "zy:zz';z+z'", constant
+        with FingerprintIndex(os.path.join(tmp, 'index')) as index:
+            assert index.analyze(sopvm.parse("a:a"))['cached']
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    _test_index()
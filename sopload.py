@@ -0,0 +1,130 @@
+import argparse
+import asyncio
+import collections
+import json
+import random
+import sys
+import time
+
+import sopserver
+
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+# Longest response line in bytes, a table of 24 inputs has 16M digits per output
+MAX_RESPONSE = 256 * 2**20
+
+def random_equation(rand, nvars, terms=6, literals=3):
+    """ Random sum of products over the first nvars letters. """
+    letters = LETTERS[:nvars]
+    return letters + ':' + '+'.join(
+        ''.join(rand.choice((v, v + "'")) for v in rand.sample(letters, min(literals, nvars)))
+        for _ in range(terms))
+
+def make_requests(rand, count, equations=32, nvars=8, vectors=16, tables=0.0, table_vars=16):
+    """
+    Request lines: evaluations of vectors random vectors over a pool of equations equations, and a
+    fraction tables of truth tables of table_vars inputs.
+    """
+    pool = [random_equation(rand, nvars) for _ in range(equations)]
+    large = [random_equation(rand, table_vars) for _ in range(max(1, equations // 8))]
+    lines = []
+    for n in range(count):
+        if rand.random() < tables:
+            record = {'id': n, 'equation': rand.choice(large), 'table': True}
+        else:
+            record = {'id': n, 'equation': rand.choice(pool),
+                      'inputs': [''.join(rand.choice('01') for _ in range(nvars)) for _ in range(vectors)]}
+        lines.append(json.dumps(record).encode('utf-8') + b'\n')
+    return lines
+
+async def client(connect, lines, depth, deadline, latencies, errors):
+    """ Send lines on one connection with up to depth requests outstanding, until deadline or the end of lines. """
+    reader, writer = await connect()
+    window = asyncio.Semaphore(depth)
+    sent = collections.deque()
+
+    async def receive():
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            latencies.append(time.perf_counter() - sent.popleft())
+            if b'"error"' in line:
+                errors.append(line)
+            window.release()
+
+    receiver = asyncio.ensure_future(receive())
+    for line in lines:
+        await window.acquire()
+        if time.perf_counter() >= deadline:
+            break
+        sent.append(time.perf_counter())
+        writer.write(line)
+        if window.locked():
+            await writer.drain()
+    await writer.drain()
+    writer.write_eof()
+    await receiver
+    writer.close()
+
+def percentile(values, fraction):
+    """ Value below which fraction of the sorted values are. """
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+async def run(connect, lines, connections=4, depth=16, duration=None):
+    """ Split lines over connections and returns the statistics as a dict, latencies in ms. """
+    deadline = time.perf_counter() + duration if duration else float('inf')
+    latencies = []
+    errors = []
+    start = time.perf_counter()
+    await asyncio.gather(*[client(connect, lines[n::connections], depth, deadline, latencies, errors)
+                           for n in range(connections)])
+    seconds = time.perf_counter() - start
+    latencies.sort()
+    stats = {'requests': len(latencies), 'errors': len(errors), 'seconds': seconds,
+             'rps': len(latencies) / seconds if seconds else 0}
+    if latencies:
+        stats.update({name: percentile(latencies, fraction) * 1e3
+                      for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99))})
+        stats['max'] = latencies[-1] * 1e3
+    return stats
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Load generator for sopserver.py: sends pipelined evaluation '
+                                     'requests and reports the requests per second and the latency.')
+    parser.add_argument('--host', default=sopserver.DEFAULT_HOST, help='server address')
+    parser.add_argument('--port', type=int, default=sopserver.DEFAULT_PORT, help='server TCP port')
+    parser.add_argument('--unix', help='connect to this Unix socket instead of TCP')
+    parser.add_argument('--connections', type=int, default=4, help='concurrent connections')
+    parser.add_argument('--depth', type=int, default=16, help='requests in flight per connection')
+    parser.add_argument('--requests', type=int, default=20000, help='requests to send in total')
+    parser.add_argument('--duration', type=float, help='stop sending after this many seconds')
+    parser.add_argument('--equations', type=int, default=32, help='distinct equations')
+    parser.add_argument('--vars', type=int, default=8, help='inputs of the equations')
+    parser.add_argument('--vectors', type=int, default=16, help='input vectors per request')
+    parser.add_argument('--tables', type=float, default=0.0, help='fraction of requests for a 16 input truth table')
+    parser.add_argument('--seed', type=int, default=240, help='random seed')
+    parser.add_argument('--json', action='store_true', help='print the statistics as JSON')
+    args = parser.parse_args(argv)
+
+    lines = make_requests(random.Random(args.seed), args.requests, args.equations, args.vars, args.vectors,
+                          args.tables)
+    if args.unix:
+        def connect():
+            return asyncio.open_unix_connection(args.unix, limit=MAX_RESPONSE)
+    else:
+        def connect():
+            return asyncio.open_connection(args.host, args.port, limit=MAX_RESPONSE)
+    try:
+        stats = asyncio.run(run(connect, lines, args.connections, args.depth, args.duration))
+    except OSError as e:
+        print('Cannot connect: %s' % e, file=sys.stderr)
+        return 1
+    if args.json:
+        print(json.dumps(stats, indent=2))
+    elif stats['requests']:
+        print('%(requests)i requests (%(errors)i errors) in %(seconds).2f s: %(rps).0f requests/s, latency p50 '
+              '%(p50).2f ms, p90 %(p90).2f ms, p99 %(p99).2f ms, max %(max).2f ms' % stats)
+    return 1 if stats['errors'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
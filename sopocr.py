@@ -1,28 +1,375 @@
 
-import multiprocessing as mp
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import json
+import logging
 import re
 import os
 import signal
 import sys
+import time
 
 import sopvm
 
-from PIL import Image
-import pyocr
-import pyocr.builders
+# Logger for this module
+_LOGGER = logging.getLogger(__name__)
+
+# PIL and pyocr are slow to import, they're imported by the functions that use them, see ocr_tool()
 
 # List of valid file extensions
 VALID_IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.bmp', '.gif']
 # Regex for Sum of Products equations. Not perfect but it gets the job done
 SOP_REGEX = re.compile(r"[\sa-zA-Z:();'+]+")
-# Get Tesseract OCR
-OCR_TOOL = pyocr.get_available_tools()[0]
 OCR_LANG = 'eng' # equ, osd, eng
+# Preprocess images before recognition, see Preprocessor
+PREPROCESS = True
+# Resolution images are scaled down to, Tesseract is tuned for about 300 DPI
+TARGET_DPI = 300
+# Width in inches of the paper, for photos that don't have a usable resolution
+PAGE_WIDTH = 8.5
+# Adaptive binarization: a pixel is black if it's darker than the mean of the pixels around it,
+# up to BINARIZE_RADIUS away, by more than BINARIZE_OFFSET
+BINARIZE_RADIUS = 15
+BINARIZE_OFFSET = 10
+# White border left around the text when cropping, in pixels
+CROP_MARGIN = 20
+# Default directory and size limit in bytes of OCRCache
+CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ocrcache')
+CACHE_SIZE = 16 * 2**20
+# EXIF orientation tag, and the transpositions that undo each orientation
+EXIF_ORIENTATION = 0x0112
+ORIENTATION_TRANSPOSE = {
+    2: 'FLIP_LEFT_RIGHT',
+    3: 'ROTATE_180',
+    4: 'FLIP_TOP_BOTTOM',
+    5: 'TRANSPOSE',
+    6: 'ROTATE_270',
+    7: 'TRANSVERSE',
+    8: 'ROTATE_90',
+}
+# OCR tool found by ocr_tool()
+_OCR_TOOL = None
+# Seconds spent by ocr_tool() and warmup() in: import, discover, warmup
+BACKEND_TIMINGS = {}
+
+class OCRError(Exception):
+    """ The file can't be recognized. """
+
+def ocr_tool():
+    """
+    Returns the pyocr tool, Tesseract if it's installed. PIL and pyocr are imported and the tools are
+    looked for on the first call, so they only slow down programs that use OCR.
+    :throws OCRError: if there's no OCR tool, or PIL or pyocr aren't installed
+    """
+    global _OCR_TOOL
+    if _OCR_TOOL is None:
+        start = time.perf_counter()
+        try:
+            import PIL.Image
+            import pyocr
+            import pyocr.builders
+        except ImportError as e:
+            raise OCRError('OCR needs PIL and pyocr: %s' % e)
+        # Load the image format drivers now rather than with the first image, so they're timed with the backend
+        PIL.Image.preinit()
+        BACKEND_TIMINGS['import'] = time.perf_counter() - start
+        start = time.perf_counter()
+        tools = pyocr.get_available_tools()
+        BACKEND_TIMINGS['discover'] = time.perf_counter() - start
+        if not tools:
+            raise OCRError('No OCR tool found, install Tesseract')
+        _OCR_TOOL = tools[0]
+    return _OCR_TOOL
+
+def image_to_string(image):
+    """ Returns the text recognized in a PIL image. """
+    import pyocr.builders
+    return ocr_tool().image_to_string(image, lang=OCR_LANG, builder=pyocr.builders.TextBuilder())
+
+def warmup():
+    """ Find the OCR tool and recognize a blank image, so the first real image isn't slower. Returns BACKEND_TIMINGS. """
+    if 'warmup' not in BACKEND_TIMINGS:
+        # First, so a missing PIL is an OCRError
+        ocr_tool()
+        from PIL import Image
+
+        start = time.perf_counter()
+        image_to_string(Image.new('L', (64, 32), 255))
+        BACKEND_TIMINGS['warmup'] = time.perf_counter() - start
+    return dict(BACKEND_TIMINGS)
+
+# Result of OCRPool: the recognized text, the compiled SOPCode (None if the text isn't a valid
+# equation), the parse error message (None if it is), the seconds spent in each stage and whether
+# it came from the OCRCache
+OCRResult = collections.namedtuple('OCRResult', ['path', 'text', 'code', 'error', 'timings', 'cached'])
+
+def clean_text(text):
+    """ Fix up OCR output for the parser: typographic quotes, and line breaks joined with spaces. """
+    text = text.replace("’", "'").replace("‘", "'")
+    return ' '.join(text.split())
+
+def validate(path, text, timings=None, cached=False):
+    """ Compile recognized text, returns an OCRResult. Handwritten variables are single letters. """
+    text = clean_text(text)
+    try:
+        return OCRResult(path, text, sopvm.parse(text, long_names=False), None, timings, cached)
+    except sopvm.ParseError as e:
+        return OCRResult(path, text, None, str(e), timings, cached)
+
+def exif_orientation(image):
+    """ Returns the EXIF orientation of image, 1 if it's upright or has no EXIF data. """
+    try:
+        exif = image.getexif()
+    except AttributeError:
+        # Pillow < 6
+        exif = getattr(image, '_getexif', lambda: None)() or {}
+    return exif.get(EXIF_ORIENTATION, 1)
+
+class Preprocessor:
+    """
+    Prepares a photo for Tesseract, which spends most of its time on pixels that aren't part of the
+    equation. The stages, each of which can be turned off:
+        rotate    - turn the image upright according to its EXIF orientation
+        grayscale - drop the colors
+        scale     - scale down to dpi, JPEG files are decoded at a lower resolution already
+        binarize  - black and white with a threshold following the local brightness, so shadows and
+                    uneven lighting don't turn into black areas
+        crop      - cut the image down to the bounding box of the dark pixels
+    The seconds spent in each stage, and in decoding the image (load), are summed in timings.
+    """
+    def __init__(self, rotate=True, dpi=TARGET_DPI, grayscale=True, binarize=True, crop=True):
+        """
+        :param dpi: resolution to scale down to, None to keep the size of the image
+        """
+        self.rotate = rotate
+        self.dpi = dpi
+        self.grayscale = grayscale or binarize
+        self.binarize = binarize
+        self.crop = crop
+        # {stage: [calls, seconds]}, like sopvm.Stats.phases
+        self.timings = {}
+
+    def __call__(self, image):
+        """ Preprocess a PIL image, returns the new image and the seconds spent in each stage. """
+        from PIL import Image
+
+        timings = collections.OrderedDict()
+        start = time.perf_counter()
+
+        def done(stage):
+            nonlocal start
+            now = time.perf_counter()
+            timings[stage] = now - start
+            entry = self.timings.setdefault(stage, [0, 0.0])
+            entry[0] += 1
+            entry[1] += now - start
+            start = now
+
+        orientation = exif_orientation(image) if self.rotate else 1
+        size = self.scaled_size(image)
+        if size is not None:
+            # Only changes the decoder of JPEG files, which then skip the extra pixels
+            image.draft('L' if self.grayscale else image.mode, size)
+        image.load()
+        done('load')
+        if orientation in ORIENTATION_TRANSPOSE:
+            image = image.transpose(getattr(Image, ORIENTATION_TRANSPOSE[orientation]))
+            done('rotate')
+        # Grayscale first, there's less to scale
+        if self.grayscale and image.mode != 'L':
+            image = image.convert('L')
+            done('grayscale')
+        if size is not None:
+            if orientation in (5, 6, 7, 8):
+                size = size[::-1]
+            if image.size[0] > size[0]:
+                image = image.resize(size, Image.BILINEAR)
+            done('scale')
+        if self.binarize:
+            image = binarize(image)
+            done('binarize')
+        if self.crop:
+            image = crop(image)
+            done('crop')
+        return image, timings
+
+    def scaled_size(self, image):
+        """ Returns the size image is scaled down to, None if it isn't larger. """
+        if self.dpi is None:
+            return None
+        dpi = image.info.get('dpi', (0, 0))[0]
+        if dpi <= 96:
+            # No resolution, or the 72 or 96 DPI cameras and screenshots use: guess from the paper size
+            dpi = min(image.size) / PAGE_WIDTH
+        if dpi <= self.dpi:
+            return None
+        return tuple(max(1, int(side * self.dpi / dpi)) for side in image.size)
+
+    def settings(self):
+        """ Returns the settings that change the output, as a dict that can be stored as JSON. """
+        return {'rotate': self.rotate, 'dpi': self.dpi, 'grayscale': self.grayscale, 'binarize': self.binarize,
+                'crop': self.crop, 'page_width': PAGE_WIDTH, 'binarize_radius': BINARIZE_RADIUS,
+                'binarize_offset': BINARIZE_OFFSET, 'crop_margin': CROP_MARGIN}
+
+    def report(self):
+        """ Returns the timings as human readable lines. """
+        return '\n'.join('%-9s %8i calls %10.3f ms %10.3f ms/call' % (
+            stage, calls, seconds * 1e3, seconds / calls * 1e3) for stage, (calls, seconds) in self.timings.items())
+
+def binarize(image, radius=BINARIZE_RADIUS, offset=BINARIZE_OFFSET):
+    """ Adaptive threshold of a grayscale image: black where it's darker than the local mean by more than offset. """
+    from PIL import ImageChops, ImageFilter
+
+    if image.mode != 'L':
+        image = image.convert('L')
+    darker = ImageChops.subtract(image.filter(ImageFilter.BoxBlur(radius)), image)
+    return darker.point([0 if value > offset else 255 for value in range(256)])
+
+def crop(image, margin=CROP_MARGIN):
+    """ Crop to the dark pixels of image, plus margin. A blank image is returned as is. """
+    if image.mode != 'L':
+        image = image.convert('L')
+    box = image.point([255 if value < 128 else 0 for value in range(256)]).getbbox()
+    if box is None:
+        return image
+    return image.crop((max(0, box[0] - margin), max(0, box[1] - margin),
+                       min(image.size[0], box[2] + margin), min(image.size[1], box[3] + margin)))
+
+class OCRCache:
+    """
+    On-disk cache of recognized images, so an image that's sent again is answered without running OCR.
+    Entries are content-addressed: the file name is a hash of the image bytes and of the OCR settings,
+    and the file holds the recognized text and its compiled SOPCode (see sopvm.dumps()). Files are
+    written atomically, so worker processes can share the directory. Once it gets larger than
+    max_bytes, the least recently used entries are removed. The cache is only an optimization, errors
+    writing it are logged and ignored.
+    """
+    def __init__(self, path=CACHE_PATH, max_bytes=CACHE_SIZE):
+        """
+        Open or create a cache.
+        :param path: directory of the cache
+        :param max_bytes: size the entries are kept under
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.errors = 0
+        # Size of the entries, counted by the first put()
+        self._bytes = None
+
+    @staticmethod
+    def key(data, settings):
+        """ Returns the key of the image bytes data recognized with settings, a dict that can be stored as JSON. """
+        digest = hashlib.sha256(data)
+        digest.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _entries(self):
+        """ Returns the (last use time, size, file name) of each entry. """
+        entries = []
+        if not os.path.isdir(self.path):
+            return entries
+        for entry in os.scandir(self.path):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def get(self, key):
+        """ Returns the (text, SOPCode or None) stored for key, None if it's not in the cache. """
+        name = os.path.join(self.path, key)
+        try:
+            with open(name, 'rb') as fp:
+                data = fp.read()
+            # The modification time is the last use time
+            os.utime(name)
+            text, _, code = data.partition(b'\0')
+            entry = text.decode('utf-8'), sopvm.loads(code) if code else None
+        except (OSError, ValueError):
+            # Not in the cache, or a damaged entry
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def put(self, key, text, code):
+        """ Store the text and SOPCode (or None) recognized for key, then evict entries if the cache is too large. """
+        name = os.path.join(self.path, key)
+        data = text.encode('utf-8') + b'\0' + (sopvm.dumps(code) if code is not None else b'')
+        tmp = '%s.%i.tmp' % (name, os.getpid())
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(tmp, 'wb') as fp:
+                fp.write(data)
+            os.replace(tmp, name)
+        except OSError as e:
+            # Read only or full disk, the result is still returned
+            self.errors += 1
+            _LOGGER.warning('Can\'t write the OCR cache: %s', e)
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+        if self._bytes is None:
+            self._bytes = sum(size for _, size, _ in self._entries())
+        else:
+            self._bytes += len(data)
+        if self._bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """ Remove the least recently used entries until the cache is under 3/4 of max_bytes. """
+        entries = sorted(self._entries())
+        self._bytes = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if self._bytes <= self.max_bytes * 3 // 4:
+                break
+            try:
+                os.remove(name)
+            except OSError:
+                # Already removed by another process
+                pass
+            self._bytes -= size
+            self.evictions += 1
+
+    def info(self):
+        """ Returns the statistics as a dict. """
+        entries = self._entries()
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'errors': self.errors,
+                'size': len(entries), 'bytes': sum(size for _, size, _ in entries), 'max_bytes': self.max_bytes}
 
 class OCRHelper:
-    def __init__(self):
-        pass
-        
+    def __init__(self, preprocess=PREPROCESS, cache=None):
+        """
+        :param preprocess: True to preprocess images with the default Preprocessor, or a Preprocessor
+        :param cache: OCRCache used by recognize(), None to always run OCR
+        """
+        if preprocess is True:
+            preprocess = Preprocessor()
+        self.preprocessor = preprocess or None
+        self.cache = cache
+        # Seconds spent in each stage by the last process(), including ocr
+        self.timings = {}
+        self._settings = None
+
+    def settings(self):
+        """ Returns the settings that change the recognized text, as a dict that can be stored as JSON. """
+        if self._settings is None:
+            tool = ocr_tool()
+            self._settings = {
+                'tool': tool.get_name(),
+                'version': tool.get_version(),
+                'lang': OCR_LANG,
+                'builder': 'TextBuilder',
+                'preprocess': self.preprocessor.settings() if self.preprocessor is not None else None,
+            }
+        return self._settings
+
     def process(self, path):
         """ Perform OCR on the file at path. Returns the resulting text. """
         ext = os.path.splitext(path)[1]
@@ -30,23 +377,196 @@ class OCRHelper:
         print("Processing file " + path)
         
         # Ignore if not an image file
-        if ext not in VALID_IMAGE_EXTENSIONS:
-            self.cb_error('Not an image')
-            return
+        if ext.lower() not in VALID_IMAGE_EXTENSIONS:
+            raise OCRError('Not an image: ' + path)
+
+        # If it was a valid image process it, once there's an OCR tool
+        ocr_tool()
+        from PIL import Image
 
-        # If it was a valid image process it
-        text = OCR_TOOL.image_to_string(
-            Image.open(path),
-            lang=OCR_LANG,
-            builder=pyocr.builders.TextBuilder()
-        )
+        image = Image.open(path)
+        timings = collections.OrderedDict()
+        if self.preprocessor is not None:
+            image, timings = self.preprocessor(image)
+        start = time.perf_counter()
+        text = image_to_string(image)
+        timings['ocr'] = time.perf_counter() - start
+        self.timings = timings
         text = text.replace("’", "'")
         return text
 
+    def recognize(self, path):
+        """ Perform OCR on the file at path, returns the validated OCRResult. Uses the cache if there is one. """
+        try:
+            if self.cache is None:
+                return validate(path, self.process(path), self.timings)
+            start = time.perf_counter()
+            with open(path, 'rb') as fp:
+                key = self.cache.key(fp.read(), self.settings())
+            entry = self.cache.get(key)
+            lookup = time.perf_counter() - start
+            if entry is not None:
+                text, code = entry
+                timings = {'cache': lookup}
+                if code is None:
+                    # Get the parse error again
+                    return validate(path, text, timings, True)
+                return OCRResult(path, text, code, None, timings, True)
+            text = self.process(path)
+        except (OCRError, OSError) as e:
+            return OCRResult(path, '', None, str(e), None, False)
+        except Exception as e:
+            # Tesseract failing, or PIL refusing the image (DecompressionBombError...)
+            return OCRResult(path, '', None, 'OCR failed: %s: %s' % (type(e).__name__, e), None, False)
+        self.timings['cache'] = lookup
+        result = validate(path, text, self.timings)
+        self.cache.put(key, result.text, result.code)
+        return result
+
+# OCRHelper of each OCRPool worker process, see _init_worker()
+_WORKER_HELPER = None
+
+def _init_worker(preprocess, cache):
+    """ Worker initializer: create the helper and run the OCR tool once, so the first image isn't slower. """
+    global _WORKER_HELPER
+    # Ctrl-C is handled by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _WORKER_HELPER = OCRHelper(preprocess, OCRCache(cache) if cache is not None else None)
+    try:
+        warmup()
+    except Exception:
+        # Reported by recognize() for each image. An exception out of the initializer would break the pool.
+        pass
+
+def _recognize(path):
+    """ Worker task: recognize and validate one image. """
+    return _WORKER_HELPER.recognize(path)
+
+def _backend_timings():
+    """ Worker task of OCRPool.warm(). """
+    return dict(BACKEND_TIMINGS)
+
+def _cache_info():
+    """ Worker task of OCRPool.cache_info(). """
+    # Hold the worker so that the other tasks of the round go to the other idle workers
+    time.sleep(0.05)
+    cache = _WORKER_HELPER.cache
+    return os.getpid(), None if cache is None else cache.info()
+
+class OCRPool:
+    """
+    Pool of warm worker processes running OCRHelper, so several images are recognized at the same time.
+    Each image gives a future of an OCRResult with the recognized text already compiled and validated.
+    """
+    def __init__(self, workers=None, preprocess=PREPROCESS, cache=CACHE_PATH):
+        """
+        Start the worker processes.
+        :param workers: number of worker processes, defaults to the number of CPUs
+        :param preprocess: passed to the OCRHelper of each worker
+        :param cache: directory of the OCRCache shared by the workers, None to always run OCR
+        """
+        self.workers = workers or os.cpu_count()
+        # Last OCRCache.info() of each worker process, see cache_info()
+        self._cache_infos = {}
+        self._executor = concurrent.futures.ProcessPoolExecutor(self.workers, initializer=_init_worker,
+                                                                initargs=(preprocess, cache))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def warm(self):
+        """
+        Start the worker processes now rather than with the first images, so they import and warm up the
+        OCR tool in the background. Returns Futures of the BACKEND_TIMINGS of the workers.
+        """
+        return [self._executor.submit(_backend_timings) for _ in range(self.workers)]
+
+    def cache_info(self, timeout=0.5):
+        """
+        Returns the OCRCache statistics of the workers (see OCRCache.info()), the counters summed over
+        every worker, or None if there's no cache. Workers busy for more than timeout seconds give
+        the counters they gave last time.
+        """
+        futures = [self._executor.submit(_cache_info) for _ in range(self.workers)]
+        done, _ = concurrent.futures.wait(futures, timeout)
+        for future in done:
+            pid, info = future.result()
+            if info is None:
+                return None
+            self._cache_infos[pid] = info
+        if not self._cache_infos:
+            return None
+        # Entries are shared on disk, the latest answer has their size
+        total = dict(info)
+        for name in ('hits', 'misses', 'evictions', 'errors'):
+            total[name] = sum(worker[name] for worker in self._cache_infos.values())
+        return total
+
+    def submit(self, path):
+        """ Queue the image at path, returns a Future of its OCRResult. """
+        return self._executor.submit(_recognize, path)
+
+    def map(self, paths):
+        """ Queue every image of paths, yields their OCRResult in the same order. """
+        return self._executor.map(_recognize, paths)
+
+    def shutdown(self, wait=True):
+        """ Stop the worker processes. """
+        self._executor.shutdown(wait)
+
+def compare(paths, preprocessor=None):
+    """
+    Recognize each image of paths without and with preprocessing, to check what it costs and saves.
+    Yields a (raw, preprocessed) pair of OCRResult for each image.
+    """
+    raw = OCRHelper(preprocess=False)
+    preprocessed = OCRHelper(preprocess=preprocessor or True)
+    for path in paths:
+        yield raw.recognize(path), preprocessed.recognize(path)
+
+def _describe(label, result):
+    """ One line of compare output: total time, validity, text and the milliseconds of each stage. """
+    timings = result.timings or {}
+    stages = ', '.join('%s %.1f' % (stage, seconds * 1e3) for stage, seconds in timings.items())
+    return '  %-12s %9.1f ms  %-7s "%s"  (%s)' % (label, sum(timings.values()) * 1e3,
+                                                 'invalid' if result.error else 'valid', result.text, stages)
+
 def main(argv):
-    helper = OCRHelper()
-    print(helper.process(argv[0]))
-    
+    parser = argparse.ArgumentParser(description='Recognize Boolean equations in images.')
+    parser.add_argument('images', nargs='+', help='image files')
+    parser.add_argument('--raw', action='store_true', help="don't preprocess the images")
+    parser.add_argument('--compare', action='store_true',
+                        help='recognize each image with and without preprocessing, and compare time and results')
+    parser.add_argument('--no-cache', action='store_true', help='run OCR even on images recognized before')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        totals = {'raw': [0, 0.0], 'preprocessed': [0, 0.0]}
+        differ = 0
+        for pair in compare(args.images):
+            print(pair[0].path)
+            for label, result in zip(('raw', 'preprocessed'), pair):
+                print(_describe(label, result))
+                totals[label][0] += result.error is None
+                totals[label][1] += sum((result.timings or {}).values())
+            differ += pair[0].text != pair[1].text
+        for label, (valid, seconds) in totals.items():
+            print('%s: %i/%i valid equations, %.3f s' % (label, valid, len(args.images), seconds))
+        print('%i images recognized differently' % differ)
+        return
+    cache = None if args.no_cache else CACHE_PATH
+    if len(args.images) > 1:
+        # Several images, recognize them in parallel
+        with OCRPool(preprocess=not args.raw, cache=cache) as pool:
+            results = list(pool.map(args.images))
+    else:
+        helper = OCRHelper(preprocess=not args.raw, cache=cache and OCRCache(cache))
+        results = [helper.recognize(args.images[0])]
+    for result in results:
+        print('%s: %s%s' % (result.path, result.error or result.text, ' (cached)' if result.cached else ''))
+
 if __name__ == '__main__':
     main(sys.argv[1:])
-
@@ -0,0 +1,228 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+import sopbatch
+import sopvm
+import soptable
+
+# Default TCP address
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 2400
+# Requests of one connection read ahead of their responses, more wait for the responses to be sent
+PIPELINE_DEPTH = 64
+# Longest request line in bytes. Lines are read on the event loop, larger records belong in sopbatch.py
+MAX_LINE = 4 * 2**20
+# Request lines of at least this many bytes, and tables with at least this many inputs, are decoded and
+# computed in the process pool so they don't hold up the other connections
+OFFLOAD_MIN_BYTES = 64 * 2**10
+OFFLOAD_MIN_VARS = 14
+
+def _handle_text(record, number):
+    """ Worker task: the result of a record as text. Tables aren't split further, this is a worker already. """
+    return ''.join(sopbatch.handle(record, number, parallel=False))
+
+def _handle_line(line, number):
+    """ Worker task: the result of a request line as text. """
+    try:
+        record = json.loads(line)
+    except ValueError as e:
+        return sopbatch.error_result(number, 'Invalid JSON: %s' % e)
+    return _handle_text(record, number)
+
+class SOPServer:
+    """
+    Evaluation server speaking the sopbatch protocol over a stream: one JSON record per line in, one JSON
+    result per line out, in the same order. A client may send many requests without waiting for the
+    responses. Every connection shares sopvm.PARSE_CACHE, so each equation is compiled once for all of
+    them. {"stats": true} returns the statistics of the server.
+    """
+    def __init__(self, pool=None):
+        """
+        :param pool: executor for the large requests, defaults to the shared pool of soptable
+        """
+        self.pool = pool
+        self.connections = 0
+        self.requests = 0
+        self.offloaded = 0
+
+    def _offload(self, record):
+        """ True if record asks for a table large enough to be computed in the pool. """
+        if not record.get('table'):
+            return False
+        try:
+            return len(sopbatch.parse_record(record).inputs) >= OFFLOAD_MIN_VARS
+        except (sopvm.ParseError, ValueError):
+            return False
+
+    def respond(self, line, number):
+        """
+        Returns the response to a request line: its text, or a task returning it if it's computed in the
+        pool. Tasks start right away, so the requests of a connection are computed in parallel.
+        """
+        self.requests += 1
+        if len(line) >= OFFLOAD_MIN_BYTES:
+            self.offloaded += 1
+            return asyncio.ensure_future(self._respond_in_pool(_handle_line, line, number))
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            return sopbatch.error_result(number, 'Invalid JSON: %s' % e)
+        try:
+            if isinstance(record, dict) and record.get('stats'):
+                return json.dumps(dict(self.info(), id=record.get('id', number))) + '\n'
+            if isinstance(record, dict) and self._offload(record):
+                self.offloaded += 1
+                return asyncio.ensure_future(self._respond_in_pool(_handle_text, record, number))
+            return ''.join(sopbatch.handle(record, number))
+        except Exception as e:
+            return self._internal_error(record, number, e)
+
+    def _internal_error(self, record, number, error):
+        """ Error response to a request that failed in an unexpected way, the connection goes on. """
+        ident = record.get('id', number) if isinstance(record, dict) else number
+        return sopbatch.error_result(ident, 'Internal error: %r' % error)
+
+    async def _respond_in_pool(self, task, request, number):
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.pool, task, request, number)
+        except Exception as e:
+            # The pool broke, or the result was too large to send back
+            return self._internal_error(request, number, e)
+
+    async def handle_connection(self, reader, writer):
+        """ Serve one connection: read requests while the responses are sent in order. """
+        self.connections += 1
+        pending = asyncio.Queue(PIPELINE_DEPTH)
+        sender = asyncio.ensure_future(self._send(pending, writer))
+        number = 0
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # Longer than MAX_LINE
+                    await pending.put(sopbatch.error_result(number + 1, 'Request too long'))
+                    break
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                number += 1
+                await pending.put(self.respond(line, number))
+        except ConnectionError:
+            pass
+        finally:
+            await pending.put(None)
+            await sender
+            writer.close()
+
+    async def _send(self, pending, writer):
+        """ Write the responses of pending in order, until None. """
+        connected = True
+        while True:
+            response = await pending.get()
+            if response is None:
+                return
+            if not isinstance(response, str):
+                response = await response
+            if not connected:
+                # Keep emptying pending so the reader isn't blocked
+                continue
+            try:
+                writer.write(response.encode('utf-8'))
+                if pending.empty():
+                    # Send a batch of pipelined responses at once
+                    await writer.drain()
+            except ConnectionError:
+                connected = False
+
+    def info(self):
+        """ Returns the statistics as a dict. """
+        return {'connections': self.connections, 'requests': self.requests, 'offloaded': self.offloaded,
+                'parse_cache': sopvm.PARSE_CACHE.info()}
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT, path=None):
+        """ Start listening on the TCP address or on the Unix socket path, returns the asyncio server. """
+        if self.pool is None:
+            self.pool = soptable.get_pool()
+        # Start the workers before any socket is open: forked later, they would keep the sockets of the
+        # connections open after the server closes them
+        await asyncio.get_running_loop().run_in_executor(self.pool, int)
+        if path is not None:
+            return await asyncio.start_unix_server(self.handle_connection, path, limit=MAX_LINE)
+        return await asyncio.start_server(self.handle_connection, host, port, limit=MAX_LINE)
+
+async def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, path=None):
+    """ Run a SOPServer until cancelled. """
+    server = await SOPServer().start(host, port, path)
+    print('Listening on %s' % (path or '%s:%i' % (host, port)), file=sys.stderr)
+    async with server:
+        await server.serve_forever()
+
+def _test_server():
+    """ Check pipelined requests over a Unix socket, including a large table and large lines computed in the pool. """
+    import shutil
+    import tempfile
+
+    async def run(path):
+        server = await SOPServer().start(path=path)
+        async with server:
+            reader, writer = await asyncio.open_unix_connection(path, limit=MAX_LINE)
+            requests = [
+                {'equation': 'abc:ab+c', 'inputs': ['110', '000']},
+                {'equation': 'abcdefghijklmnop:ab+cd', 'table': True},
+                'not json',
+                {'equation': 'ab:a;b', 'inputs': [[1, 0]], 'id': 'list'},
+                {'equation': 'ab:a+b', 'inputs': ['01'] * (OFFLOAD_MIN_BYTES // 5)},
+                {'equation': 'ab:a+b', 'inputs': ['0x'] * (OFFLOAD_MIN_BYTES // 5), 'id': 'bad'},
+                {'stats': True},
+            ]
+            for request in requests:
+                writer.write((request if isinstance(request, str) else json.dumps(request)).encode() + b'\n')
+            await writer.drain()
+            writer.write_eof()
+            responses = [json.loads(line) for line in (await reader.read()).splitlines()]
+            writer.close()
+        return responses
+
+    path = os.path.join(tempfile.mkdtemp(), 'sopserver.sock')
+    try:
+        responses = asyncio.run(run(path))
+    finally:
+        soptable.shutdown_pool()
+        shutil.rmtree(os.path.dirname(path))
+    assert responses[0] == {'id': 1, 'names': ['a', 'b', 'c'], 'outputs': ['1', '0']}
+    assert responses[1]['id'] == 2 and len(responses[1]['table'][0]) == 2**16
+    assert responses[2]['id'] == 3 and 'error' in responses[2]
+    assert responses[3] == {'id': 'list', 'names': ['a', 'b'], 'outputs': [[1, 0]]}
+    assert responses[4]['id'] == 5 and responses[4]['outputs'] == ['1'] * (OFFLOAD_MIN_BYTES // 5)
+    assert responses[5]['id'] == 'bad' and 'error' in responses[5]
+    assert responses[6]['requests'] == 7 and responses[6]['offloaded'] == 3
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Serve Boolean equation evaluation over TCP or a Unix socket, '
+                                     'one JSON request per line (see sopbatch.py).')
+    parser.add_argument('--host', default=DEFAULT_HOST, help='address to listen on, %s by default' % DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='TCP port, %i by default' % DEFAULT_PORT)
+    parser.add_argument('--unix', help='listen on this Unix socket instead of TCP')
+    parser.add_argument('--test', action='store_true', help='run the self test')
+    args = parser.parse_args(argv)
+
+    if args.test:
+        _test_server()
+        return 0
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        soptable.shutdown_pool()
+        if args.unix and os.path.exists(args.unix):
+            os.remove(args.unix)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
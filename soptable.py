@@ -0,0 +1,341 @@
+import collections
+import concurrent.futures
+import os
+import time
+
+import sopvm
+
+# log2 of the number of rows evaluated in one block
+CHUNK_BITS = 16
+# Tables with at least this many inputs are split over the process pool by table()
+PARALLEL_MIN_VARS = 20
+
+# Shared process pool, see get_pool()
+_POOL = None
+
+def get_pool(workers=None):
+    """
+    Returns the shared process pool, starting it on the first call.
+    The pool is reused by every table so the startup cost is only paid once.
+    :param workers: number of worker processes, defaults to the number of CPUs
+    """
+    global _POOL
+    if _POOL is None:
+        _POOL = concurrent.futures.ProcessPoolExecutor(workers or os.cpu_count())
+    return _POOL
+
+def shutdown_pool():
+    """ Stop the shared process pool if it was started. """
+    global _POOL
+    if _POOL is not None:
+        _POOL.shutdown()
+        _POOL = None
+
+def _group_source(group):
+    """ Python expression of a group from SOPCode.groups(), over the list of inputs i. """
+    terms = []
+    for term in group:
+        factors = []
+        for sub, inv in term:
+            expr = _group_source(sub) if isinstance(sub, tuple) else 'i[%i]' % sub
+            factors.append(('not ' + expr) if inv else expr)
+        terms.append('(' + ' and '.join(factors) + ')' if factors else 'True')
+    return '(' + ' or '.join(terms) + ')' if terms else 'False'
+
+def _group_support(group, support):
+    """ Add the inputs a group from SOPCode.groups() depends on to the set support. """
+    for term in group:
+        for sub, _ in term:
+            if isinstance(sub, tuple):
+                _group_support(sub, support)
+            else:
+                support.add(sub)
+    return support
+
+class GrayEvaluator:
+    """
+    Incremental truth table evaluation. Rows are walked in Gray code order so exactly one input changes
+    from one row to the next, and only the product terms that contain that input are evaluated again.
+    Each product term keeps its number of false factors and each output its number of true terms.
+    Parenthesized groups inside a term are evaluated again as a whole when one of their inputs changes.
+    This is fastest for sparse support, when each input is only in a small part of the terms.
+    """
+    def __init__(self, code):
+        """
+        Build the input -> term index of a SOPCode.
+        :param code: SOPCode to evaluate
+        """
+        nvars = len(code.inputs)
+        self.nvars = nvars
+        outputs = code.groups()
+        self.num_outputs = len(outputs)
+        self._term_output = []  # Output of each product term
+        self._term_size = []    # Number of factors of each product term
+        self._rising = [[] for _ in range(nvars)]   # Input -> terms with a literal that becomes true on 1
+        self._falling = [[] for _ in range(nvars)]  # Input -> terms with a literal that becomes false on 1
+        self._literals = []     # (term, input, inverted) of every literal, for the first row of a block
+        self._factors = [[] for _ in range(nvars)]  # Input -> groups that depend on it
+        self._factor_term = []  # Term of each group factor
+        self._factor_func = []  # Function evaluating each group factor, inversion included
+        for n, group in enumerate(outputs):
+            for term in group:
+                t = len(self._term_output)
+                self._term_output.append(n)
+                self._term_size.append(len(term))
+                for sub, inv in term:
+                    if isinstance(sub, tuple):
+                        f = len(self._factor_term)
+                        self._factor_term.append(t)
+                        expr = ('not ' if inv else '') + _group_source(sub)
+                        self._factor_func.append(eval(compile('lambda i: bool(%s)' % expr, '<soptable>', 'eval'),
+                                                      {'__builtins__': {'bool': bool}}))
+                        for j in _group_support(sub, set()):
+                            self._factors[j].append(f)
+                    else:
+                        (self._falling if inv else self._rising)[sub].append(t)
+                        self._literals.append((t, sub, inv))
+
+    def block(self, bits, base=0):
+        """
+        Evaluate a block of contiguous rows, returns one integer per output like SOPCode.table().
+        :param bits: log2 of the number of rows, the Gray code walks the low bits
+        :param base: first row, must be a multiple of 2**bits
+        """
+        inputs = [bool((base >> j) & 1) for j in range(self.nvars)]
+        # Initial state for the first row
+        false = list(self._term_size)
+        for t, j, inv in self._literals:
+            if inputs[j] != inv:
+                false[t] -= 1
+        factor_value = [func(inputs) for func in self._factor_func]
+        for f, value in enumerate(factor_value):
+            if value:
+                false[self._factor_term[f]] -= 1
+        true = [0] * self.num_outputs
+        for t, count in enumerate(false):
+            if not count:
+                true[self._term_output[t]] += 1
+
+        term_output = self._term_output
+        rising, falling, factors = self._rising, self._falling, self._factors
+        factor_term, factor_func = self._factor_term, self._factor_func
+        columns = [bytearray(1 << bits) for _ in true]
+        # Only the outputs that are true have to be written for each row
+        active = set(n for n, count in enumerate(true) if count)
+        for n in active:
+            columns[n][0] = 1
+        for step in range(1, 1 << bits):
+            # The input to flip is the number of trailing zeros of the step
+            j = (step & -step).bit_length() - 1
+            on = inputs[j] = not inputs[j]
+            up, down = (rising[j], falling[j]) if on else (falling[j], rising[j])
+            for t in up:
+                count = false[t] - 1
+                false[t] = count
+                if not count:
+                    n = term_output[t]
+                    true[n] += 1
+                    active.add(n)
+            for t in down:
+                count = false[t]
+                false[t] = count + 1
+                if not count:
+                    n = term_output[t]
+                    true[n] -= 1
+                    if not true[n]:
+                        active.discard(n)
+            for f in factors[j]:
+                value = factor_func[f](inputs)
+                if value != factor_value[f]:
+                    factor_value[f] = value
+                    t = factor_term[f]
+                    count = false[t]
+                    n = term_output[t]
+                    if value:
+                        false[t] = count - 1
+                        if count == 1:
+                            true[n] += 1
+                            active.add(n)
+                    else:
+                        false[t] = count + 1
+                        if not count:
+                            true[n] -= 1
+                            if not true[n]:
+                                active.discard(n)
+            row = step ^ (step >> 1)
+            for n in active:
+                columns[n][row] = 1
+        # One byte per row to an integer with bit r for row r
+        return [int(column[::-1].translate(_BINARY_DIGITS), 2) for column in columns]
+
+# Translation of 0/1 bytes to binary digits, see GrayEvaluator.block()
+_BINARY_DIGITS = bytes.maketrans(b'\0\1', b'01')
+
+# Table evaluation engines, see iter_blocks()
+ENGINES = ('vector', 'gray')
+
+def _eval_block(code, bits, base, engine='vector'):
+    """ Worker task: evaluate one block of rows. code is sent pickled as bytecode, not as text. """
+    if engine == 'gray':
+        return GrayEvaluator(code).block(bits, base)
+    return code.table(bits, base)
+
+def iter_blocks(code, chunk_bits=CHUNK_BITS, pool=None, engine='vector'):
+    """
+    Evaluate the truth table of code in blocks of 2**chunk_bits contiguous rows.
+    Yields (first row, list of output columns) in row order, see SOPCode.table().
+    :param code: SOPCode to evaluate
+    :param chunk_bits: log2 of the number of rows per block
+    :param pool: executor to evaluate the blocks in, None to evaluate them here
+    :param engine: 'vector' to evaluate every row at once with big integers (SOPCode.table()), 'gray' to
+        evaluate the rows one by one incrementally (GrayEvaluator)
+    """
+    if engine not in ENGINES:
+        raise ValueError('Unknown table engine %s' % engine)
+    nvars = len(code.inputs)
+    bits = min(chunk_bits, nvars)
+    bases = range(0, 1 << nvars, 1 << bits)
+    if pool is None:
+        evaluate = GrayEvaluator(code).block if engine == 'gray' else code.table
+        for base in bases:
+            yield base, evaluate(bits, base)
+        return
+    # Keep a bounded number of blocks in flight so memory stays bounded too
+    window = 2 * os.cpu_count()
+    pending = collections.deque()
+    for base in bases:
+        pending.append((base, pool.submit(_eval_block, code, bits, base, engine)))
+        if len(pending) >= window:
+            base, future = pending.popleft()
+            yield base, future.result()
+    while pending:
+        base, future = pending.popleft()
+        yield base, future.result()
+
+def table(code, parallel=None, chunk_bits=CHUNK_BITS, engine='vector'):
+    """
+    Evaluate the whole truth table of code, returns one integer per output like SOPCode.table().
+    :param parallel: split the rows over the shared process pool, by default only when the equation
+        has at least PARALLEL_MIN_VARS inputs
+    :param engine: one of ENGINES, see iter_blocks()
+    """
+    nvars = len(code.inputs)
+    if parallel is None:
+        parallel = nvars >= PARALLEL_MIN_VARS
+    if not parallel or nvars <= chunk_bits or chunk_bits < 3:
+        if engine == 'gray':
+            return GrayEvaluator(code).block(nvars)
+        return code.table()
+    # Blocks are whole bytes, so merge them into byte arrays rather than shifting big integers
+    block_bytes = (1 << chunk_bits) // 8
+    columns = None
+    for base, block in iter_blocks(code, chunk_bits, get_pool(), engine):
+        if columns is None:
+            columns = [bytearray((1 << nvars) // 8) for _ in block]
+        offset = base // 8
+        for column, value in zip(columns, block):
+            column[offset:offset + block_bytes] = value.to_bytes(block_bytes, 'little')
+    return [int.from_bytes(column, 'little') for column in columns]
+
+# Formats supported by write_table()
+FORMATS = ('text', 'csv', 'jsonl', 'bits')
+
+def iter_text(code, fmt='csv', pool=None, engine='vector'):
+    """
+    Generate the truth table of code as text, one string per block of rows so memory stays bounded.
+    Formats:
+        text  - the REPL format, columns separated by two spaces with the equation in the header
+        csv   - header of the input names and out0, out1, ... then one row per line
+        jsonl - one {"inputs": [...], "outputs": [...]} object per line
+    :param pool: executor to evaluate the blocks in, None to evaluate them here
+    :param engine: one of ENGINES, see iter_blocks()
+    """
+    nvars = len(code.inputs)
+    bits = min(CHUNK_BITS, nvars)
+    sep = '  ' if fmt == 'text' else ','
+    if fmt == 'text':
+        yield ''.join(name + sep for name in code.inputs) + str(code) + '\n'
+    elif fmt == 'csv':
+        yield sep.join(list(code.inputs) + ['out%i' % n for n in range(code.num_outputs)]) + '\n'
+    elif fmt != 'jsonl':
+        raise ValueError('Unknown table format %s' % fmt)
+    # The inputs that change within a block are the same in every block
+    low = [sep.join(str((row >> j) & 1) for j in range(bits)) for row in range(1 << bits)]
+    for base, columns in iter_blocks(code, bits, pool, engine):
+        high = ''.join(sep + str((base >> j) & 1) for j in range(bits, nvars))
+        outputs = [format(col, '0%ib' % len(low))[::-1] for col in columns]
+        if fmt == 'jsonl':
+            yield '\n'.join('{"inputs":[%s%s],"outputs":[%s]}' % (inputs, high, sep.join(outs))
+                             for inputs, outs in zip(low, zip(*outputs))) + '\n'
+        else:
+            yield '\n'.join(inputs + high + sep + sep.join(outs)
+                            for inputs, outs in zip(low, zip(*outputs))) + '\n'
+
+def write_bits(code, fp, pool=None, engine='vector'):
+    """
+    Write the truth table of code to the seekable binary file fp as packed bits.
+    Each output is one column of 2**n bits, row r being bit (r % 8) of byte (r // 8), and the columns
+    follow each other, so the file can be memory-mapped as a (num_outputs x 2**n / 8) byte array.
+    Columns are padded to a whole byte when there are fewer than 3 inputs.
+    :param pool: executor to evaluate the blocks in, None to evaluate them here
+    :param engine: one of ENGINES, see iter_blocks()
+    """
+    nvars = len(code.inputs)
+    bits = min(CHUNK_BITS, nvars)
+    block_bytes = max(1, (1 << bits) // 8)
+    column_bytes = max(1, (1 << nvars) // 8)
+    start = fp.tell()
+    for base, columns in iter_blocks(code, bits, pool, engine):
+        for n, col in enumerate(columns):
+            fp.seek(start + n * column_bytes + base // 8)
+            fp.write(col.to_bytes(block_bytes, 'little'))
+
+def write_table(code, path, fmt='csv', parallel=None, engine='vector'):
+    """
+    Stream the truth table of code to a file in large buffered chunks.
+    Returns the number of rows written.
+    :param path: file name, or an open text file for the text formats (e.g. sys.stdout)
+    :param fmt: one of FORMATS, see iter_text() and write_bits()
+    :param parallel: use the shared process pool, by default only from PARALLEL_MIN_VARS inputs
+    :param engine: one of ENGINES, see iter_blocks()
+    """
+    nvars = len(code.inputs)
+    if parallel is None:
+        parallel = nvars >= PARALLEL_MIN_VARS
+    pool = get_pool() if parallel else None
+    start = time.perf_counter() if sopvm.PROFILING else 0
+    if fmt == 'bits':
+        with open(path, 'wb') as fp:
+            write_bits(code, fp, pool, engine)
+    elif isinstance(path, str):
+        with open(path, 'w', buffering=1 << 20) as fp:
+            for chunk in iter_text(code, fmt, pool, engine):
+                fp.write(chunk)
+    else:
+        for chunk in iter_text(code, fmt, pool, engine):
+            path.write(chunk)
+    if sopvm.PROFILING:
+        sopvm.STATS.add_time('output', time.perf_counter() - start)
+    return 1 << nvars
+
+def _test_engines():
+    """ Check that both engines give SOPCode.table() for every block size. """
+    TESTS = [
+        "abc:ab+(b+c)'",
+        "abcd:(a+b')(c'+d)'+a(b(c+d));aa';a+a'",
+        "abcde:de(a'b'c'+ab'c');de(a'bc'+abc');(a+b)'e+de;(a+b)'c+de",
+        "abc:ab+c;ab+c;a",
+    ]
+    for expr in TESTS:
+        for cse in (False, True):
+            code = sopvm.parse(expr, cse=cse)
+            nvars = len(code.inputs)
+            for bits in range(nvars + 1):
+                for base in range(0, 1 << nvars, 1 << bits):
+                    assert GrayEvaluator(code).block(bits, base) == code.table(bits, base), (expr, bits, base)
+            for engine in ENGINES:
+                assert table(code, engine=engine) == code.table(), (expr, engine)
+    print('Both engines match SOPCode.table() for %i equations' % len(TESTS))
+
+if __name__ == '__main__':
+    _test_engines()
@@ -1,14 +1,32 @@
 
+import array
+import collections
+import copyreg
+import gc
+import hashlib
+import json
+import os
+import pickle
 import pprint
 import re
+import struct
+import sys
+import time
+import weakref
 
 import lark
 from lark.common import ParseError, UnexpectedToken
+from lark.lexer import LexError
+from lark.parsers import lalr_analysis
 
-sop_parser = lark.Lark(r'''
+# Variable names are single letters, or identifiers such as x17 or req_valid with long names
+SHORT_NAME_REGEX = r'[a-zA-Z]'
+LONG_NAME_REGEX = r'[a-zA-Z_][a-zA-Z0-9_]*'
+
+SOP_GRAMMAR = r'''
     out : ";"
     orr : "+"
-    ?variable_id : /[a-zA-Z]/
+    ?variable_id : /NAME_REGEX/
     variable : variable_id
     prefix : variable_id+
     ?expression : variable
@@ -19,158 +37,295 @@ sop_parser = lark.Lark(r'''
 
     %import common.WS
     %ignore WS
-    ''', start='main', parser='lalr')
+    '''
+
+# Directory where the analyzed parser is cached, see _load_parser()
+PARSER_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__pycache__')
+
+def _pickle_action(action):
+    """ lark compares LALR actions by identity (action is Shift), so pickle them as their global name. """
+    return action.name
+
+def _load_parser(grammar):
+    """
+    Returns the LALR parser for grammar. Building the parse table is a noticeable part of the import
+    time, so the parser is pickled to PARSER_CACHE_DIR the first time and loaded from there afterwards.
+    The file name contains a hash of the grammar and the lark and Python versions, so changing any of
+    them builds a new one. Any problem with the cache falls back to building the parser.
+    """
+    key = '\0'.join([grammar, getattr(lark, '__version__', ''), sys.version])
+    path = os.path.join(PARSER_CACHE_DIR, 'sopvm-parser-%s.pickle' % hashlib.sha1(key.encode('utf-8')).hexdigest()[:16])
+    try:
+        with open(path, 'rb') as fp:
+            parser = pickle.load(fp)
+        parser.parse(':a')
+        return parser
+    except Exception:
+        pass
+    parser = lark.Lark(grammar, start='main', parser='lalr')
+    try:
+        pickler_table = copyreg.dispatch_table.copy()
+        pickler_table[lalr_analysis.Action] = _pickle_action
+        os.makedirs(PARSER_CACHE_DIR, exist_ok=True)
+        tmp = '%s.%i' % (path, os.getpid())
+        with open(tmp, 'wb') as fp:
+            pickler = pickle.Pickler(fp, pickle.HIGHEST_PROTOCOL)
+            pickler.dispatch_table = pickler_table
+            pickler.dump(parser)
+        os.replace(tmp, path)
+    except Exception:
+        # Read only directory or a parser that can't be pickled, just don't cache it
+        pass
+    return parser
+
+sop_parser = _load_parser(SOP_GRAMMAR.replace('NAME_REGEX', SHORT_NAME_REGEX))
+# Parser for long names, loaded by get_parser() when first needed
+_long_parser = None
+
+def get_parser(long_names=False):
+    """ Returns the parser for single letter variables, or for long names. """
+    global _long_parser
+    if not long_names:
+        return sop_parser
+    if _long_parser is None:
+        _long_parser = _load_parser(SOP_GRAMMAR.replace('NAME_REGEX', LONG_NAME_REGEX))
+    return _long_parser
 
 # Matches any illegal character
 INV_TOKEN_REGEX = re.compile(r"[^\sa-zA-Z()+;':]")
+LONG_INV_TOKEN_REGEX = re.compile(r"[^\sa-zA-Z0-9_()+;':]")
+# Matches any character that's only valid in long names
+LONG_NAME_CHAR_REGEX = re.compile(r"[0-9_]")
 
 ORD_CUT = ord('a')
 
+# Header of serialized SOPCode: magic, version, bytecode typecode, inputs length, text length, bytecode length
+SOP_MAGIC = b'SOPC'
+# Version 2 has space separated input names, version 3 adds the temporary slot opcodes
+SOP_VERSION = 3
+_SOP_HEADER = struct.Struct('<4sBcIII')
+
+# Number of compiled equations kept by parse()
+PARSE_CACHE_SIZE = 1024
+
 # We declare this here so that clients can import sopvm.<whatever>
 ParseError = ParseError
 UnexpectedToken = UnexpectedToken
 
-def flatten(lis):
-    out = []
-    for item in lis:
-        if type(item) is list:
-            out.extend(flatten(item))
-        else:
-            out.append(item)
-    return out
-
-class TransGetVariables(lark.Transformer):
+class SymbolTable:
     """
-    Transformer which gets a list of variables.
+    The input names of an equation in input order, mapping each name to a dense integer slot.
+    Tables are interned (see intern()) so the equations over the same inputs share one table.
     """
-    def __init__(self):
-        super().__init__()
-        self._variables = set()
-        self._prefix = None
-
-    def variable(self, name_):
-        name, = name_
-        self._variables.add(name)
-
-    def prefix(self, variables):
-        self._prefix = ''.join([x[0] for x in variables])
-        return self._prefix
-
-    def main(self, tree_):
-        if self._prefix:
-            # Return the user-defined prefix
-            return self._prefix
-        else:
-            # Return a list of variables sorted according to a logical sorting order
-            lis = list(self._variables)
-            lis.sort(key=lambda x: ord(x) - ORD_CUT if ord(x) >= ORD_CUT else ord(x))
-            return ''.join(lis)
-
-class TransCompile(lark.Transformer):
-    """ Transformer that generates a list of Opcode objects from a lark.Tree """
-    def __init__(self, inputs=None):
-        """
-        Initialize a 
-        :param inputs: user-supplied prefix string (optional)
-        """
-        super().__init__()
-        self.inputs = {}
-        self._opid = 0
-        self._has_prefix = False
+    __slots__ = ('names', '_index', '__weakref__')
 
-        if inputs:
-            self._process_prefix(inputs)
+    # Interned tables, by names
+    _tables = weakref.WeakValueDictionary()
 
-    def _next_opid(self):
-        """
-        Generate a unique Opcode ID for this program.
-        Used when we need unique Opcode IDs, mostly for specifying where an OP_OR is going to jump to.
-        """
-        self._opid += 1
-        return self._opid
-
-    def _process_prefix(self, variables):
-        """ Process a string of variables into the inputs variables """
-        count = 0
-        for varid in variables:
-            self.inputs[varid] = count
-            count += 1
-        return self.inputs
-        
-    def orr(self, _):
-        """ OP_OR """
-        return OpOr(0)
-
-    def out(self, _):
-        """ OP_OUT """
-        return OpOut(0)
-
-    def expression(self, children):
-        """ Transform an expression """
-        return children
-
-    def equation(self, children):
+    def __init__(self, names):
+        """ Use intern() rather than creating tables directly. """
+        self.names = tuple(names)
+        self._index = dict((name, n) for n, name in enumerate(self.names))
+
+    @classmethod
+    def intern(cls, names):
+        """ Returns the shared table for names. """
+        # Names may be lark Tokens, keep plain strings so tables pickle and compare cheaply
+        names = tuple(str(name) for name in names)
+        table = cls._tables.get(names)
+        if table is None:
+            table = cls._tables[names] = cls(names)
+        return table
+
+    @property
+    def long_names(self):
+        """ True if any name isn't a single letter, so equations need the long names grammar. """
+        return any(len(name) != 1 or not name.isalpha() for name in self.names)
+
+    def index(self, name):
+        """ Returns the slot of name, raises KeyError if it's not an input. """
+        return self._index[name]
+
+    def dense(self, mapping):
         """
-        Transform an equation into opcodes, also fill in OP_OR params.
+        Convert a sparse {name: bool} mapping to a list of values in input order, missing names are False.
+        :throws KeyError: if a name isn't an input
         """
-        # Fill in OP_OR to jump to this OP_POP
-        oppop = OpPop(self._next_opid())
-        for i in range(len(children)):
-            op = children[i]
-            if isinstance(op, OpOr):
-                op.param = oppop.opid
-        return [OpPush(0)] + children + [oppop]
-    
-    def invert(self, sub_):
-        """ NOT the previous expression. """
-        sub = sub_[0]
-        if isinstance(sub, OpAnd):
-            # If it's a simple expression it's a simple NAND
-            return OpNand(sub.param, self.inputs)
-        else:
-            # If it's an equation we need to invert POP
-            sub[-1].param = True
-            return sub
-        
-    def variable(self, name):
-        """ Convert a variable to an Opcode """
-        return OpAnd(name[0], self.inputs)
-    
-    def prefix(self, variables):
-        """ Handle the prefix if present. """
-        # Collect a series of tokens into a string
-        varids = [x[0] for x in variables]
-        self._has_prefix = True
-        return self._process_prefix(varids)
-
-    def main(self, tree):
-        """ Converts the nested lists to a single list. """
-        # Remove the prefix if it wasn't implied
-        if self._has_prefix:
-            tree = tree[1:]
-        return flatten(tree + [OpOut(0)])
-
-def _compile(text, inputs=None):
-    """
-    Compile the given text, returns an array of opcodes or raises a ParseError.
-    :param text: Text to compile, if no prefix is supplied, inputs must be supplied
-    :param inputs: replacement for "prefix" if prefix is not part of "text"
+        values = [False] * len(self.names)
+        index = self._index
+        for name, value in mapping.items():
+            values[index[name]] = value
+        return values
+
+    def join(self, names):
+        """ Join names the way equations separate them, with spaces only for long names. """
+        return (' ' if self.long_names else '').join(names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __getitem__(self, n):
+        return self.names[n]
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __eq__(self, other):
+        if isinstance(other, SymbolTable):
+            return self.names == other.names
+        try:
+            return self.names == tuple(other)
+        except TypeError:
+            return NotImplemented
+
+    def __hash__(self):
+        return hash(self.names)
+
+    def __str__(self):
+        return self.join(self.names)
+
+    def __repr__(self):
+        return 'SymbolTable(%r)' % (self.names,)
+
+def _variable_order(name):
+    """ Sort key for variables: lowercase letters first, then uppercase. """
+    return ord(name) - ORD_CUT if ord(name) >= ORD_CUT else ord(name)
+
+def _long_variable_order(name):
+    """ Sort key for long names: numbers inside names are compared by value, so x2 comes before x10. """
+    parts = re.split(r'(\d+)', name)
+    parts[1::2] = [int(x) for x in parts[1::2]]
+    return parts
+
+def uses_long_names(text, inputs=None):
+    """
+    Returns True if text needs the long names grammar: it has a digit or an underscore, or inputs
+    has names that aren't single letters.
+    """
+    if LONG_NAME_CHAR_REGEX.search(text):
+        return True
+    if inputs is None or isinstance(inputs, str):
+        return False
+    return SymbolTable.intern(inputs).long_names
+
+def parse_tree(text, long_names=False):
+    """
+    Parse text to a lark.Tree, adding the ':' if there's no prefix.
+    :throws ParseError: if text is not a valid equation
     """
+    token_check(text, long_names)
     # The text MUST contain a :
-    if ':' not in text:
+    added = ':' not in text
+    if added:
         text = ':' + text
-    tree = sop_parser.parse(text)
-    opcodes = TransCompile(inputs).transform(tree)
-    # We've got an array of opcodes, we just need to fill in OP_OR jumps
-    jumplist = {}
-    for i in range(len(opcodes) - 1, 0, -1):
-        op = opcodes[i]
-        if isinstance(op, OpPop):
-            jumplist[op.opid] = i
-        elif isinstance(op, OpOr):
-            # Fill in the jump value from the jumplist
-            op.param = jumplist[op.param] - i
-    return opcodes
+    try:
+        return get_parser(long_names).parse(text)
+    except LexError as e:
+        # Characters the grammar has no token for, such as a name starting with a digit
+        line = getattr(e, 'line', 1)
+        column = getattr(e, 'column', 1) - (added and line == 1)
+        context = getattr(e, 'context', '')[:1]
+        raise ParseError('Invalid token \'%s\' at line %i, column %i' % (context, line, column))
+
+def _compile(text, inputs=None, long_names=False):
+    """
+    Compile the given text in a single parse, returns (bytecode array, SymbolTable of the inputs)
+    or raises a ParseError.
+    The lark.Tree is walked with an explicit stack, so deep nesting can't hit the recursion limit,
+    and the bytecode is written into one preallocated buffer with each OR patched when its POP is
+    emitted, so compiling is linear in the size of the text.
+    :param text: Text to compile
+    :param inputs: replacement for "prefix" if prefix is not part of "text", by default every
+        variable in sorted order
+    :param long_names: use the long names grammar, where names in a product are separated by spaces
+    """
+    # The tree is a lot of objects without any cycles, collecting while it's built only makes
+    # parsing superlinear
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        if not PROFILING:
+            return _compile_tree(parse_tree(text, long_names), text, inputs, long_names)
+        start = time.perf_counter()
+        tree = parse_tree(text, long_names)
+        split = time.perf_counter()
+        STATS.add_time('parse', split - start)
+        result = _compile_tree(tree, text, inputs, long_names)
+        STATS.add_time('compile', time.perf_counter() - split)
+        return result
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+def _compile_tree(tree, text, inputs, long_names):
+    """ Generate the bytecode for a tree parsed from text, see _compile(). """
+    # Every op comes from a character of the text, except PUSH/POP around the top level equation
+    # and OUT, which are at most 3 per ';'
+    buf = array.array('I', bytes(8 * (len(text) + 3 * (text.count(';') + 1))))
+    size = 0
+    slots = {}      # Variable name -> index in order of appearance, remapped at the end
+    prefix = None
+    for child in tree.children:
+        if child.data == 'prefix':
+            prefix = [str(token) for token in child.children]
+            continue
+        if child.data == 'out':
+            buf[size] = OP_OUT
+            size += 2
+            continue
+        stack = [(child, False)]
+        while stack:
+            node, inv = stack.pop()
+            if isinstance(node, list):
+                # End of a group: [OR positions to patch, invert]
+                for pos in node[0]:
+                    buf[pos + 1] = (size - pos) // 2
+                buf[size] = OP_POP
+                buf[size + 1] = int(node[1])
+                size += 2
+            elif node.data == 'variable':
+                name = node.children[0]
+                slot = slots.get(name)
+                if slot is None:
+                    slot = slots[name] = len(slots)
+                buf[size] = OP_NAND if inv else OP_AND
+                buf[size + 1] = slot
+                size += 2
+            elif node.data == 'invert':
+                stack.append((node.children[0], not inv))
+            elif node.data == 'orr':
+                # inv holds the OR positions of the group here
+                inv.append(size)
+                buf[size] = OP_OR
+                size += 2
+            else:
+                # equation
+                jumps = []
+                buf[size] = OP_PUSH
+                size += 2
+                stack.append(([jumps, inv], None))
+                for sub in reversed(node.children):
+                    stack.append((sub, jumps if sub.data == 'orr' else False))
+    buf[size] = OP_OUT
+    size += 2
+    del buf[size:]
+
+    # Map the variables to inputs
+    if prefix is None:
+        prefix = inputs or sorted(slots, key=_long_variable_order if long_names else _variable_order)
+    index = dict((name, n) for n, name in enumerate(prefix))
+    remap = []
+    for name in slots:
+        if name not in index:
+            raise ParseError('Variable \'%s\' is not in the prefix' % name)
+        remap.append(index[name])
+    for pos in range(0, size, 2):
+        if buf[pos] <= OP_NAND:
+            buf[pos + 1] = remap[buf[pos + 1]]
+    return _to_array(buf), SymbolTable.intern(prefix)
 
 def _test_compile():
     """ Tests for _compile() """
@@ -182,146 +337,1339 @@ def _test_compile():
         "ab:ab",
         "ab:ab;a+b;a'b",
         ("ab'+a'b", "ab"),
+        "abc:aba(b)+cc'+(a'')'",
+        "abcdefg:abcdefg+(c+d)'a",
+        "abcde:(a+b)'e+de;(a+b)'c+de;(a+b)'d",
     ]
     for expr in TESTS:
         print('Parsing ', expr)
         try:
             if isinstance(expr, str):
-                opcodes = _compile(expr)
+                code, _ = _compile(expr)
             else:
-                opcodes = _compile(expr[0], expr[1])
-            pprint.pprint([str(x) for x in opcodes], width=20)
+                code, _ = _compile(expr[0], expr[1])
+            pprint.pprint(disassemble(code), width=20)
+            code, removed = optimize(code)
+            print('Optimized (%i ops removed):' % removed)
+            pprint.pprint(disassemble(code), width=20)
+            shared, saved = eliminate_common(code)
+            if saved:
+                print('Shared subexpressions (%i ops saved):' % saved)
+                pprint.pprint(disassemble(shared), width=20)
         except ParseError as e:
             print(e)
+    # Text the lexer rejects is a ParseError too
+    for expr in ("x1 + 2", "a:1b", "x1 x2:x1 (x2 + 3y)"):
+        try:
+            parse(expr, cache=False)
+        except ParseError as e:
+            print(expr, '->', e)
+        else:
+            raise AssertionError(expr)
+    assert list(parse("ready ack + clk'", long_names=True).inputs) == ['ack', 'clk', 'ready']
+    # Too deep for the generated function, eval() still returns bools
+    deep = parse('a' + '(b+' * 2000 + 'c' + ')' * 2000, cache=False)
+    assert deep.eval([True, False, True]) == [True], deep.eval([True, False, True])
+    data = bytearray(dumps(deep))
+    data[4] = SOP_VERSION + 1
+    try:
+        loads(bytes(data))
+    except ValueError as e:
+        assert 'version %i' % (SOP_VERSION + 1) in str(e), e
+    else:
+        raise AssertionError('newer version loaded')
+    assert list(parse("ready ack").inputs) == list(parse("ready ack", long_names=False).inputs) == list('acdekry')
+    # Spaces between letters don't matter with single letters
+    assert parse("abc:ab c").table() == parse("abc:abc").table()
+    assert parse("ab+cd ef").table() == parse("ab+cdef").table()
+    assert list(parse("a b c:a b + c'").inputs) == ['a', 'b', 'c']
+
+def _test_eval():
+    """ Check that eval() matches the reference interpreter for every row of the truth table. """
+    TESTS = [
+        "abc:ab+(b+c)'",
+        "abc:ab+(c)'+c'",
+        "ab:a+((b))'",
+        "ab:a(a+b)",
+        "ab:ab;a+b;a'b",
+        "abcd:(a+b')(c'+d)'+a(b(c+d))",
+        "abc:aba(b)+cc'+(a'')';aa';(a+a')c",
+        "abcdefg:abcdefg+(c+d)'a+a(b+c)(d+e)",
+        "x1 x2' + req_valid (x10 + x2)'; x3_b",
+        "abcd:c(a'b')'+b'd'",
+        "abcde:de(a'b'c'+ab'c');de(a'bc'+abc');(a+b)'e+de;(a+b)'c+de",
+        # Outputs repeating a whole shared group
+        "ab:ab;ab",
+        "abc:ab+c;ab+c",
+        "abcd:(a+b)(c+d)';(a+b)(c+d)';a",
+    ]
+    for expr in TESTS:
+        code = parse(expr)
+        reference = parse(expr, opt=False)
+        shared = parse(expr, cse=True)
+        n = len(code.inputs)
+        for row in range(2**n):
+            inputs = [bool((row >> j) & 1) for j in range(n)]
+            expect = [bool(x) for x in reference.interpret(inputs)]
+            assert [bool(x) for x in code.interpret(inputs)] == expect, (expr, inputs)
+            assert code.eval(inputs) == expect, (expr, inputs, code.source)
+            assert [bool(x) for x in shared.interpret(inputs)] == expect, (expr, inputs)
+            assert shared.eval(inputs) == expect, (expr, inputs, shared.source)
+        assert loads(dumps(code)).interpret(inputs) == code.interpret(inputs)
+        assert loads(dumps(shared)).table() == shared.table() == code.table()
+        columns = code.table()
+        for row in range(2**n):
+            inputs = [bool((row >> j) & 1) for j in range(n)]
+            assert [bool((col >> row) & 1) for col in columns] == code.eval(inputs), (expr, inputs)
+            assert code.eval(dict(zip(code.inputs, inputs))) == code.eval(inputs), (expr, inputs)
+    print('eval() and table() match interpret() for %i equations' % len(TESTS))
+
+def _test_minimize():
+    """ Check that minimize() keeps the truth table in both modes. """
+    TESTS = [
+        "abc:ab+a'b+ab'",
+        "abc:a'b'c'+a'b'c+a'bc+abc+abc'",
+        "abcd:ab'c+abc+a'bc+ab'c'+abcd;a'b'c'd';aa'",
+    ]
+    for expr in TESTS:
+        code = parse(expr)
+        for mode in ('exact', 'heuristic'):
+            small = minimize(code, mode)
+            assert small.table() == code.table(), (expr, mode, small.text)
+            print('Minimized %s (%s) to %s' % (expr, mode, small.text))
 
 
 #########################################################################################
-# These Op* classes basically implement the VM. The interpreter calls the eval() method
-# for each Opcode in the list, and that's how it all works.
+# The compiler emits a compact bytecode array which is what SOPCode keeps and what the
+# interpreter, the code generator and the bit-parallel evaluator run.
 #########################################################################################
 
-class Opcode:
-    """ Base Opcode class. """
-    def __init__(self, param):
-        self.param = param
-
-class OpAnd(Opcode):
-    """ AND the current value with the param. """
-    def __init__(self, param, inputs):
-        self.param = param
-        self.var = inputs[param]
-    def eval(self, ctx):
-        ctx.v &= ctx.input[self.var]
-    def __str__(self):
-        return 'AND ' + self.param
-        
-class OpNand(OpAnd):
-    """ NAND the current value with the param. """
-    def eval(self, ctx):
-        ctx.v &= not ctx.input[self.var]
-    def __str__(self):
-        return 'NAND ' + self.param
-        
-class OpPop(Opcode):
-    """ POP a value from the stack and AND (if !param) or NAND (if param) with the current value. """
-    def __init__(self, opid):
-        self.opid = opid
-        self.param = False
-    def eval(self, ctx):
-        # ctx.v XOR self.param = NAND if param, AND if !param
-        ctx.v = (ctx.v ^ self.param) and ctx.stack.pop()
-    def __str__(self):
-        return 'POP ' + ('NOT ' if self.param else '')
-
-class OpOr(Opcode):
-    """ If the current value is True, short-circuit. """
-    def eval(self, ctx):
-        if ctx.v:
-            # change the interpreter position
-            ctx.pos += self.param - 1
-        ctx.v = True
-    def __str__(self):
-        return 'OR ' + str(self.param)
+# Bytecode opcodes. Each instruction is a pair of array items: (opcode, operand)
+OP_AND = 0      # operand: input index
+OP_NAND = 1     # operand: input index
+OP_OR = 2       # operand: relative jump (in instructions) to the matching POP
+OP_PUSH = 3     # operand: unused
+OP_POP = 4      # operand: 1 to invert, 0 otherwise
+OP_OUT = 5      # operand: unused
+OP_JF = 6       # operand: relative jump (in instructions) to the end of the product term if False
+OP_STORE = 7    # operand: temporary slot, like OP_OUT but saves the value in the slot
+OP_LOAD = 8     # operand: temporary slot
+OP_LOADN = 9    # operand: temporary slot, inverted
 
-class OpOut(Opcode):
-    """ Write the current value to the next output slot. """
-    def eval(self, ctx):
-        ctx.output.append(ctx.v)
-        ctx.v = True
-    def __str__(self):
-        return 'OUT'
+OP_NAMES = ['AND', 'NAND', 'OR', 'PUSH', 'POP', 'OUT', 'JF', 'STORE', 'LOAD', 'LOADN']
 
-class OpPush(Opcode):
-    """ Push the current value on to the stack. """
-    def eval(self, ctx):
-        ctx.stack.append(ctx.v)
-        ctx.v = True
-    def __str__(self):
-        return 'PUSH'
-
-class EvalContext:
-    """ Interpreter context. """
-    def __init__(self, inputs):
-        self.v = True           # Current evaluated value
-        self.output = []        # List of outputs, usually only 1
-        self.stack = []         # Stack (see PUSH and POP)
-        self.input = inputs     # list of input values (booleans)
-        self.done = False       # Is the interpreter done?
-        self.pos = 0            # Position in Opcode list
+# Minimum number of literals between two OP_JF in a product term, see optimize()
+JF_SPACING = 4
+
+def _to_array(items):
+    """ Convert bytecode items to an array, using 16 bit items unless an operand doesn't fit. """
+    typecode = 'H' if max(items, default=0) < 0x10000 else 'I'
+    return array.array(typecode, items)
+
+def disassemble(code):
+    """ Returns a list of human readable instructions for a bytecode array. """
+    out = []
+    for pos in range(0, len(code), 2):
+        op, arg = code[pos], code[pos + 1]
+        if op in (OP_PUSH, OP_OUT) or (op == OP_POP and not arg):
+            out.append(OP_NAMES[op])
+        elif op == OP_POP:
+            out.append('POP NOT')
+        else:
+            out.append('%s %i' % (OP_NAMES[op], arg))
+    return out
+
+#########################################################################################
+# Optimizer. The bytecode is decoded back into nested tuples, simplified, and emitted
+# again. A group is a tuple of product terms (OR), a product term is a tuple of factors
+# (AND) and a factor is (input index, inverted) or (group, inverted).
+# An empty group is False and an empty product term is True.
+# Shared subexpressions (see eliminate_common()) are (_Temp, inverted) factors.
+#########################################################################################
+
+class _Temp:
+    """ Factor reading a temporary slot written by OP_STORE. """
+    __slots__ = ('slot',)
+
+    def __init__(self, slot):
+        self.slot = slot
+
+def _decode(code):
+    """
+    Rebuild the structure of a program from its bytecode. Returns one group per output.
+    Temporary slots are expanded back into the subexpression they hold.
+    """
+    groups = [[]]   # Finished product terms of each open PUSH/POP group
+    terms = [[]]    # Factors of the current product term of each open group
+    temps = {}      # Group stored in each temporary slot
+    outputs = []
+    for pos in range(0, len(code), 2):
+        op, arg = code[pos], code[pos + 1]
+        if op == OP_AND or op == OP_NAND:
+            terms[-1].append((arg, op == OP_NAND))
+        elif op == OP_LOAD or op == OP_LOADN:
+            terms[-1].append((temps[arg], op == OP_LOADN))
+        elif op == OP_OR:
+            groups[-1].append(tuple(terms[-1]))
+            terms[-1] = []
+        elif op == OP_PUSH:
+            groups.append([])
+            terms.append([])
+        elif op == OP_POP:
+            group = tuple(groups.pop() + [tuple(terms.pop())])
+            terms[-1].append((group, bool(arg)))
+        elif op == OP_OUT:
+            outputs.append(tuple(groups[-1] + [tuple(terms[-1])]))
+            groups[-1] = []
+            terms[-1] = []
+        elif op == OP_STORE:
+            temps[arg] = tuple(groups[-1] + [tuple(terms[-1])])
+            groups[-1] = []
+            terms[-1] = []
+    return outputs
+
+def _simplify_group(group):
+    """ Simplify the terms of a group, dropping false and duplicate terms. """
+    out = []
+    seen = set()
+    for term in group:
+        term = _simplify_term(term)
+        if term is None or term in seen:
+            continue
+        if not term:
+            # One true term makes the whole group true
+            return ((),)
+        out.append(term)
+        seen.add(term)
+    if len(out) == 1 and len(out[0]) == 1 and isinstance(out[0][0][0], tuple) and not out[0][0][1]:
+        # ((a+b)) is just (a+b)
+        return out[0][0][0]
+    return tuple(out)
+
+def _simplify_term(term):
+    """ Simplify the factors of a product term. Returns None if the term is always false. """
+    out = []
+    seen = set()
+    literals = {}
+    pending = list(reversed(term))
+    while pending:
+        sub, inv = pending.pop()
+        if not isinstance(sub, tuple):
+            # Drop duplicate literals, x x' is always false
+            if sub in literals:
+                if literals[sub] != inv:
+                    return None
+                continue
+            literals[sub] = inv
+            out.append((sub, inv))
+            continue
+        sub = _simplify_group(sub)
+        if not sub or sub == ((),):
+            # Constant group: a true factor is dropped, a false factor makes the term false
+            if bool(sub) == inv:
+                return None
+        elif len(sub) == 1 and not inv:
+            # (ab) is just ab
+            pending.extend(reversed(sub[0]))
+        elif len(sub) == 1 and len(sub[0]) == 1:
+            # (a)' is a', (x)'' is x
+            fsub, finv = sub[0][0]
+            pending.append((fsub, not finv))
+        elif (sub, inv) not in seen:
+            out.append((sub, inv))
+            seen.add((sub, inv))
+    return tuple(out)
+
+def _emit_group(group, items):
+    """ Append the bytecode of the terms of group to items, ORs jump to the POP or OUT that follows. """
+    jumps = []
+    for n, term in enumerate(group):
+        if n:
+            jumps.append(len(items))
+            items.extend((OP_OR, 0))
+        _emit_term(term, items)
+    for pos in jumps:
+        items[pos + 1] = (len(items) - pos) // 2
+
+def _emit_term(term, items):
+    """
+    Append the bytecode of a product term to items. Literals come first since they're cheap, and
+    OP_JF skips the rest of the term once it's false before each group and every JF_SPACING literals.
+    """
+    factors = [f for f in term if not isinstance(f[0], tuple)] + [f for f in term if isinstance(f[0], tuple)]
+    jumps = []
+    since = 0
+    for n, (sub, inv) in enumerate(factors):
+        group = isinstance(sub, tuple)
+        if n and (group or (since >= JF_SPACING and len(factors) - n >= 2)):
+            jumps.append(len(items))
+            items.extend((OP_JF, 0))
+            since = 0
+        if group:
+            items.extend((OP_PUSH, 0))
+            _emit_group(sub, items)
+            items.extend((OP_POP, int(inv)))
+        elif isinstance(sub, _Temp):
+            items.extend((OP_LOADN if inv else OP_LOAD, sub.slot))
+        else:
+            items.extend((OP_NAND if inv else OP_AND, sub))
+        since += 1
+    for pos in jumps:
+        items[pos + 1] = (len(items) - pos) // 2
+
+def _emit(outputs, temps=()):
+    """
+    Generate bytecode from a list of output groups.
+    :param temps: groups to compute into temporary slots 0, 1, ... before the outputs
+    """
+    items = []
+    for slot, group in enumerate(temps):
+        _emit_group(group, items)
+        items.extend((OP_STORE, slot))
+    for group in outputs:
+        if not group:
+            # Constant false, there's no opcode for it but (x + x')' is false
+            items.extend((OP_PUSH, 0, OP_POP, 1))
+        else:
+            # Outputs start with a true value so they don't need PUSH/POP
+            _emit_group(group, items)
+        items.extend((OP_OUT, 0))
+    return _to_array(items)
+
+def optimize(code):
+    """
+    Optimize bytecode. Collapses groups with a single term, removes duplicate literals and terms, folds
+    x x' to false, and adds OP_JF to short-circuit false AND chains.
+    Returns (new bytecode, number of ops removed). The OP_JF added are not counted as removed.
+    :param code: bytecode array as returned by _compile()
+    """
+    try:
+        outputs = [_simplify_group(group) for group in _decode(code)]
+        new = _emit(outputs)
+    except RecursionError:
+        # Too deeply nested to optimize
+        return code, 0
+    added = sum(1 for pos in range(0, len(new), 2) if new[pos] == OP_JF)
+    return new, (len(code) - len(new)) // 2 + added
+
+def _term_cost(term):
+    """ Number of instructions emitted for a product term, not counting OP_JF. """
+    return sum(_group_cost(sub) + 2 if isinstance(sub, tuple) else 1 for sub, _ in term)
+
+def _group_cost(group):
+    """ Number of instructions emitted for a group, not counting OP_JF. """
+    return sum(_term_cost(term) for term in group) + max(0, len(group) - 1)
+
+def _count_common(group, terms, groups):
+    """
+    Count how many times each product term and group occurs in group and its subgroups.
+    A group is only walked the first time it's seen, since it will be computed once if it's shared.
+    """
+    for term in group:
+        if len(term) > 1:
+            terms[term] = terms.get(term, 0) + 1
+        for sub, _ in term:
+            if isinstance(sub, tuple):
+                groups[sub] = groups.get(sub, 0) + 1
+                if groups[sub] == 1:
+                    _count_common(sub, terms, groups)
+
+def _worth_sharing(cost, count):
+    """ True if computing a subexpression once into a slot is fewer instructions than count copies. """
+    # The subexpression and one OP_STORE, then one OP_LOAD per use
+    return count > 1 and cost * count > cost + 1 + count
+
+def _share_group(group, shared, slots, temps):
+    """
+    Rewrite group so the subexpressions in shared read their temporary slot.
+    New slots are numbered after the slots of their own subexpressions, so temps is in evaluation order.
+    :param shared: set of the terms and groups to share
+    :param slots: {subexpression: _Temp} of the slots assigned so far
+    :param temps: list of the group computed into each slot, extended as slots are assigned
+    """
+    out = []
+    for term in group:
+        if term in slots:
+            out.append(((slots[term], False),))
+            continue
+        factors = []
+        for sub, inv in term:
+            if isinstance(sub, tuple):
+                if sub in slots:
+                    sub = slots[sub]
+                elif sub in shared:
+                    temps.append(_share_group(sub, shared, slots, temps))
+                    slots[sub] = _Temp(len(temps) - 1)
+                    sub = slots[sub]
+                else:
+                    sub = _share_group(sub, shared, slots, temps)
+            factors.append((sub, inv))
+        if term in shared:
+            temps.append((tuple(factors),))
+            slots[term] = _Temp(len(temps) - 1)
+            factors = [(slots[term], False)]
+        out.append(tuple(factors))
+    return tuple(out)
+
+def eliminate_common(code):
+    """
+    Common subexpression elimination across every output. Product terms and parenthesized groups that
+    occur several times are computed once into a temporary slot (OP_STORE) at the start of the program
+    and read back with OP_LOAD wherever they're used. The code is simplified like optimize() first.
+    Returns (new bytecode, number of instructions saved by sharing).
+    :param code: bytecode array as returned by _compile() or optimize()
+    """
+    try:
+        outputs = [_simplify_group(group) for group in _decode(code)]
+        terms = {}
+        groups = {}
+        for group in outputs:
+            groups[group] = groups.get(group, 0) + 1
+            if groups[group] == 1:
+                _count_common(group, terms, groups)
+        shared = set(term for term, count in terms.items() if _worth_sharing(_term_cost(term), count))
+        # Groups are mostly factors, a use costs the group and its PUSH/POP
+        shared.update(group for group, count in groups.items()
+                      if group and _worth_sharing(_group_cost(group) + 2, count))
+        if not shared:
+            return _emit(outputs), 0
+        slots = {}
+        temps = []
+        new_outputs = []
+        for group in outputs:
+            # An output that is a whole shared group is a group of one term reading the slot
+            if group in slots:
+                new_outputs.append((((slots[group], False),),))
+            elif group in shared:
+                temps.append(_share_group(group, shared, slots, temps))
+                slots[group] = _Temp(len(temps) - 1)
+                new_outputs.append((((slots[group], False),),))
+            else:
+                new_outputs.append(_share_group(group, shared, slots, temps))
+        plain = _emit(outputs)
+        new = _emit(new_outputs, temps)
+    except RecursionError:
+        # Too deeply nested to optimize
+        return code, 0
+    if len(new) >= len(plain):
+        return plain, 0
+    return new, (len(plain) - len(new)) // 2
+
+def _join_terms(terms):
+    """ Join a list of product terms (lists of factor expressions) into one Python OR expression. """
+    return '(' + ' or '.join(('(' + ' and '.join(t) + ')') if t else 'True' for t in terms) + ')'
+
+def _codegen(code):
+    """
+    Translate bytecode into the source of an equivalent Python lambda.
+    The lambda takes the list of inputs and returns the list of outputs, e.g.
+    "lambda i: [bool(((i[0] and not i[1]) or (i[1])))]".
+    :param code: bytecode array as returned by _compile()
+    """
+    groups = [[]]   # Finished product terms of each open PUSH/POP group
+    terms = [[]]    # Factors of the current product term of each open group
+    stores = []     # Expressions computing the temporary slots
+    outputs = []
+    for pos in range(0, len(code), 2):
+        op, arg = code[pos], code[pos + 1]
+        if op == OP_AND:
+            terms[-1].append('i[%i]' % arg)
+        elif op == OP_NAND:
+            terms[-1].append('not i[%i]' % arg)
+        elif op == OP_LOAD:
+            terms[-1].append('t[%i]' % arg)
+        elif op == OP_LOADN:
+            terms[-1].append('not t[%i]' % arg)
+        elif op == OP_OR:
+            groups[-1].append(terms[-1])
+            terms[-1] = []
+        elif op == OP_PUSH:
+            groups.append([])
+            terms.append([])
+        elif op == OP_POP:
+            expr = _join_terms(groups.pop() + [terms.pop()])
+            terms[-1].append(('not ' + expr) if arg else expr)
+        elif op == OP_OUT:
+            outputs.append('bool(' + _join_terms(groups[-1] + [terms[-1]]) + ')')
+            groups[-1] = []
+            terms[-1] = []
+        elif op == OP_STORE:
+            # Slots are stored in order, so appending to t fills them in
+            stores.append('t.append(' + _join_terms(groups[-1] + [terms[-1]]) + ')')
+            groups[-1] = []
+            terms[-1] = []
+    if stores:
+        # Compute the temporaries left to right in a tuple, then the outputs
+        return 'lambda i: (lambda t: (' + ', '.join(stores) + ', [' + ', '.join(outputs) + '])[-1])([])'
+    return 'lambda i: [' + ', '.join(outputs) + ']'
+
+def input_masks(count, bits, base=0):
+    """
+    Build the bit vectors of the inputs for a block of truth table rows.
+    Bit r of vector j is the value of input j in row (base + r), input 0 being the least significant bit
+    of the row number, so the vectors cover rows base to base + 2**bits - 1.
+    :param count: number of inputs
+    :param bits: log2 of the number of rows in the block
+    :param base: first row of the block, must be a multiple of 2**bits
+    """
+    size = 1 << bits
+    full = (1 << size) - 1
+    masks = []
+    for j in range(count):
+        if j >= bits:
+            # Input is constant within the block
+            masks.append(full if (base >> j) & 1 else 0)
+            continue
+        # 2**j zeros followed by 2**j ones, repeated by doubling until it covers the block
+        period = 2 << j
+        mask = ((1 << (1 << j)) - 1) << (1 << j)
+        while period < size:
+            mask |= mask << period
+            period <<= 1
+        masks.append(mask)
+    return masks
+
+def _eval_vector(code, vectors, full):
+    """
+    Evaluate bytecode over bit vectors instead of single booleans, computing many rows in one pass.
+    Works with any type that supports &, | and ^ (big integers, NumPy boolean arrays).
+    :param code: bytecode array
+    :param vectors: one vector per input
+    :param full: vector with every bit set, used for NOT and as the initial value
+    :returns: list of output vectors
+    """
+    zero = full ^ full
+    v = full            # Current product term
+    acc = zero          # OR of the finished product terms of the current group
+    stack = []
+    temps = {}
+    outputs = []
+    for pos in range(0, len(code), 2):
+        op, arg = code[pos], code[pos + 1]
+        if op == OP_AND:
+            v = v & vectors[arg]
+        elif op == OP_NAND:
+            v = v & (vectors[arg] ^ full)
+        elif op == OP_LOAD:
+            v = v & temps[arg]
+        elif op == OP_LOADN:
+            v = v & (temps[arg] ^ full)
+        elif op == OP_OR:
+            # No short-circuit, every row is evaluated
+            acc = acc | v
+            v = full
+        elif op == OP_PUSH:
+            stack.append((v, acc))
+            v = full
+            acc = zero
+        elif op == OP_POP:
+            res = acc | v
+            if arg:
+                res = res ^ full
+            v, acc = stack.pop()
+            v = v & res
+        elif op == OP_OUT:
+            outputs.append(acc | v)
+            v = full
+            acc = zero
+        elif op == OP_STORE:
+            temps[arg] = acc | v
+            v = full
+            acc = zero
+    return outputs
+
+# Functions that depend on at most this many inputs are fingerprinted by their truth table, larger
+# ones by their BDD (see SOPCode.fingerprint())
+FINGERPRINT_TABLE_MAX_VARS = 16
+
+def _sorted_names(names):
+    """
+    Sort variable names like the inputs of an equation without prefix, so x2 comes before x10. Chains
+    like x1 x2' + x2 x3' have small BDDs in that order and exponential ones in plain string order.
+    """
+    names = list(names)
+    if any(len(name) != 1 or not name.isalpha() for name in names):
+        return tuple(sorted(names, key=_long_variable_order))
+    return tuple(sorted(names, key=_variable_order))
+
+def _remap_inputs(code, mapping):
+    """ Returns a copy of bytecode with input n replaced by input mapping[n]. """
+    items = list(code)
+    for pos in range(0, len(items), 2):
+        if items[pos] <= OP_NAND:
+            items[pos + 1] = mapping[items[pos + 1]]
+    return _to_array(items)
 
 class SOPCode:
-    def __init__(self, opcodes, inputs, text=""):
-        self._code = opcodes
+    """
+    A compiled equation. Holds the bytecode, the names of the inputs and the source text.
+    Use dumps()/loads() to save and restore it.
+    """
+    __slots__ = ('_code', 'text', 'inputs', '_func')
+
+    def __init__(self, code, inputs, text=""):
+        """
+        :param code: bytecode array
+        :param inputs: input names in input order, a SymbolTable or a sequence of names
+        :param text: equation source text
+        """
+        self._code = code
         self.text = text
-        self.inputs = inputs
+        self.inputs = inputs if isinstance(inputs, SymbolTable) else SymbolTable.intern(inputs)
+        # Generated Python function, built on the first call to eval() (see _codegen())
+        self._func = None
+
+    def __reduce__(self):
+        """ Pickle as serialized bytecode, the generated function can't be pickled. """
+        return (loads, (dumps(self),))
+
+    @property
+    def num_outputs(self):
+        """ Number of outputs (';' separated equations). """
+        code = self._code
+        return sum(1 for pos in range(0, len(code), 2) if code[pos] == OP_OUT)
+
+    @property
+    def source(self):
+        """ Source of the generated Python function. """
+        return _codegen(self._code)
+
+    def groups(self):
+        """
+        Returns the simplified structure of each output as nested tuples, see _decode(). Shared
+        subexpressions are expanded.
+        """
+        return [_simplify_group(group) for group in _decode(self._code)]
+
+    def support(self):
+        """
+        Returns the tuple of the names of the inputs that at least one output depends on, in the order
+        of the inputs of an equation without prefix (see _sorted_names()).
+        :throws sopbdd.BDDLimitError: if there are more than FINGERPRINT_TABLE_MAX_VARS inputs and the BDD
+            is too large
+        """
+        nvars = len(self.inputs)
+        if nvars > FINGERPRINT_TABLE_MAX_VARS:
+            import sopbdd
+
+            bdd, outputs = sopbdd._build(self)
+            return _sorted_names(bdd.support(outputs))
+        full = (1 << (1 << nvars)) - 1
+        columns = self.table()
+        names = []
+        for j, mask in enumerate(input_masks(nvars, nvars)):
+            # Input j matters if the rows where it's 1 differ from the rows where it's 0
+            shift = 1 << j
+            if any(((col & mask) >> shift) != (col & (full ^ mask)) for col in columns):
+                names.append(self.inputs[j])
+        return _sorted_names(names)
+
+    def fingerprint(self):
+        """
+        Returns a canonical hash of the function computed by this equation, as a hex string.
+        Equations over the same input names that compute the same outputs have the same fingerprint,
+        however they're written, whatever the order of the prefix and whatever unused inputs it has.
+        The function is hashed as its packed truth table over its support in sorted order when it has
+        at most FINGERPRINT_TABLE_MAX_VARS inputs in its support, as its reduced BDD otherwise.
+        :throws sopbdd.BDDLimitError: if the BDD is too large
+        """
+        names = self.support()
+        digest = hashlib.sha256()
+        digest.update(b'%i\0' % self.num_outputs)
+        digest.update('\0'.join(names).encode('utf-8') + b'\0')
+        if len(names) > FINGERPRINT_TABLE_MAX_VARS:
+            import sopbdd
+
+            bdd = sopbdd.BDD()
+            for name in names:
+                bdd.declare(name)
+            outputs = bdd.build_code(self)
+            digest.update(b'B' + bdd.signature(outputs))
+            return digest.hexdigest()
+        # Support inputs in sorted order, every other input is the constant input after them
+        nvars = len(names)
+        index = dict((name, n) for n, name in enumerate(names))
+        code = _remap_inputs(self._code, [index.get(name, nvars) for name in self.inputs])
+        full = (1 << (1 << nvars)) - 1
+        digest.update(b'T')
+        for col in _eval_vector(code, input_masks(nvars + 1, nvars), full):
+            digest.update(col.to_bytes(max(1, (1 << nvars) // 8), 'little'))
+        return digest.hexdigest()
+
+    def _build_func(self):
+        """ Compile the generated source, or fall back to the interpreter. """
+        try:
+            return eval(compile(self.source, '<sopvm>', 'eval'), {'__builtins__': {'bool': bool}})
+        except (SyntaxError, RecursionError, MemoryError):
+            # Too deeply nested for the Python compiler. interpret() gives ints, eval() gives bools.
+            interpret = self.interpret
+            return lambda inputs: [bool(x) for x in interpret(inputs)]
 
     def eval(self, inputs):
         """
-        Evaluate this equation with the given inputs.
-        :param inputs: list of bools
+        Evaluate this equation with the given inputs using the generated function.
+        :param inputs: list of bools in input order, or a {name: bool} dict where missing names are False
+        """
+        if isinstance(inputs, dict):
+            inputs = self.inputs.dense(inputs)
+        func = self._func
+        if func is None:
+            func = self._func = self._build_func()
+        return func(inputs)
+
+    # eval() without profiling, see enable_stats()
+    _eval_fast = eval
+
+    def _eval_profiled(self, inputs):
+        """ eval() while profiling: timed, then run again in _count_ops() to count the opcodes. """
+        if isinstance(inputs, dict):
+            inputs = self.inputs.dense(inputs)
+        start = time.perf_counter()
+        outputs = self._eval_fast(inputs)
+        STATS.add_time('eval', time.perf_counter() - start)
+        _count_ops(self._code, inputs, STATS)
+        return outputs
+
+    def interpret(self, inputs):
+        """
+        Evaluate this equation with the given inputs using the bytecode interpreter.
+        This is slower than eval() but is kept as the reference implementation.
+        :param inputs: list of bools in input order, or a {name: bool} dict where missing names are False
         """
-        ctx = EvalContext(inputs)
+        if isinstance(inputs, dict):
+            inputs = self.inputs.dense(inputs)
         code = self._code
         codelen = len(code)
-        while ctx.pos < codelen:
-            code[ctx.pos].eval(ctx)
-            ctx.pos += 1
-        return ctx.output
+        v = True            # Current evaluated value
+        stack = []          # Stack (see PUSH and POP)
+        temps = {}          # Temporary slots (see STORE and LOAD)
+        output = []         # List of outputs, usually only 1
+        pos = 0             # Position in the bytecode
+        while pos < codelen:
+            op = code[pos]
+            if op == OP_AND:
+                v &= inputs[code[pos + 1]]
+            elif op == OP_NAND:
+                v &= not inputs[code[pos + 1]]
+            elif op == OP_OR:
+                if v:
+                    # Short-circuit to the matching POP
+                    pos += 2 * code[pos + 1]
+                    continue
+                v = True
+            elif op == OP_PUSH:
+                stack.append(v)
+                v = True
+            elif op == OP_JF:
+                if not v:
+                    # Skip the rest of the product term
+                    pos += 2 * code[pos + 1]
+                    continue
+            elif op == OP_POP:
+                # v XOR operand = NAND if operand, AND if not. Pop first so the stack is always popped
+                v = stack.pop() and (v ^ code[pos + 1])
+            elif op == OP_OUT:
+                output.append(v)
+                v = True
+            elif op == OP_LOAD:
+                v &= temps[code[pos + 1]]
+            elif op == OP_LOADN:
+                v &= not temps[code[pos + 1]]
+            else:
+                temps[code[pos + 1]] = v
+                v = True
+            pos += 2
+        return output
+
+    def table(self, bits=None, base=0):
+        """
+        Evaluate a block of truth table rows in a single bit-parallel pass.
+        Returns one integer per output, bit r being the value of the output for row (base + r).
+        :param bits: log2 of the number of rows, defaults to the whole table
+        :param base: first row, must be a multiple of 2**bits
+        """
+        if bits is None:
+            bits = len(self.inputs)
+        full = (1 << (1 << bits)) - 1
+        return _eval_vector(self._code, input_masks(len(self.inputs), bits, base), full)
+
+    # table() without profiling, see enable_stats()
+    _table_fast = table
+
+    def _table_profiled(self, bits=None, base=0):
+        """ table() while profiling. """
+        start = time.perf_counter()
+        columns = self._table_fast(bits, base)
+        STATS.add_time('table', time.perf_counter() - start)
+        return columns
+
+    def eval_many(self, inputs, packed=False):
+        """
+        Evaluate this equation for many input vectors at once using NumPy.
+        Returns an (N x num_outputs) boolean array.
+        :param inputs: (N x num_vars) array of bools, or any object supporting the buffer protocol
+            (bytes, mmap, memoryview...) holding one byte per input, which is used without copying
+        :param packed: if True each row of inputs is packed into (num_vars + 7) // 8 bytes instead,
+            input 0 being the least significant bit of the first byte
+        """
+        import numpy
+
+        nvars = len(self.inputs)
+        width = (nvars + 7) // 8 if packed else nvars
+        if isinstance(inputs, numpy.ndarray):
+            data = inputs
+        else:
+            try:
+                data = numpy.frombuffer(memoryview(inputs), dtype=numpy.uint8)
+            except TypeError:
+                # Not a buffer, probably a list of lists
+                data = numpy.asarray(inputs)
+        data = data.reshape(-1, width)
+
+        columns = []
+        for j in range(nvars):
+            if packed:
+                col = (data[:, j >> 3] >> (j & 7)) & 1
+            else:
+                col = data[:, j]
+            columns.append(col if col.dtype == numpy.bool_ else col != 0)
+        full = numpy.ones(len(data), dtype=numpy.bool_)
+        return numpy.stack(_eval_vector(self._code, columns, full), axis=1)
 
     def __str__(self):
         return self.text
 
-def token_check(text):
+#########################################################################################
+# Profiling. Off by default: enable_stats() swaps instrumented versions of SOPCode.eval()
+# and SOPCode.table() into the class, so they don't cost anything when it's off. The
+# other phases check PROFILING once per call.
+#########################################################################################
+
+class Stats:
+    """
+    Counters collected while profiling.
+        phases    - {phase: [calls, seconds]} for parse, compile, optimize, cse, eval, table and output
+        opcodes   - {opcode name: times executed} over every eval()
+        evals     - number of eval() calls
+        or_tests  - OP_OR executed, or_taken of them short-circuited the rest of the group
+        jf_tests  - OP_JF executed, jf_taken of them skipped the rest of the product term
+        max_depth - highest stack depth (PUSH without POP) reached
+        cse_programs, cse_saved - programs compiled with cse=True and the instructions sharing saved
+                    in them, counted even when profiling is off
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """ Clear every counter. """
+        self.phases = {}
+        self.opcodes = dict((name, 0) for name in OP_NAMES)
+        self.evals = 0
+        self.or_tests = 0
+        self.or_taken = 0
+        self.jf_tests = 0
+        self.jf_taken = 0
+        self.max_depth = 0
+        self.cse_programs = 0
+        self.cse_saved = 0
+
+    def add_time(self, phase, seconds):
+        """ Count one call of phase taking seconds. """
+        entry = self.phases.get(phase)
+        if entry is None:
+            entry = self.phases[phase] = [0, 0.0]
+        entry[0] += 1
+        entry[1] += seconds
+
+    def as_dict(self):
+        """ Returns every counter as a dict that can be stored as JSON. """
+        return {
+            'profiling': PROFILING,
+            'phases': dict((phase, {'calls': calls, 'seconds': seconds})
+                           for phase, (calls, seconds) in self.phases.items()),
+            'evals': self.evals,
+            'opcodes': dict(self.opcodes),
+            'ops_per_eval': sum(self.opcodes.values()) / self.evals if self.evals else 0.0,
+            'or_tests': self.or_tests,
+            'or_taken': self.or_taken,
+            'or_hit_rate': self.or_taken / self.or_tests if self.or_tests else 0.0,
+            'jf_tests': self.jf_tests,
+            'jf_taken': self.jf_taken,
+            'jf_hit_rate': self.jf_taken / self.jf_tests if self.jf_tests else 0.0,
+            'max_depth': self.max_depth,
+            'cse_programs': self.cse_programs,
+            'cse_saved': self.cse_saved,
+            'parse_cache': PARSE_CACHE.info(),
+        }
+
+    def to_json(self, indent=None):
+        """ Returns the counters as a JSON string, see as_dict(). """
+        return json.dumps(self.as_dict(), indent=indent, sort_keys=True)
+
+    def report(self):
+        """ Returns the counters as human readable lines. """
+        data = self.as_dict()
+        lines = ['Profiling is %s' % ('on' if PROFILING else 'off')]
+        for phase, entry in sorted(data['phases'].items()):
+            lines.append('%-9s %8i calls %10.3f ms %10.3f us/call' % (
+                phase, entry['calls'], entry['seconds'] * 1e3, entry['seconds'] / entry['calls'] * 1e6))
+        lines.append('%i evals, %.1f opcodes per eval, stack depth up to %i' % (
+            data['evals'], data['ops_per_eval'], data['max_depth']))
+        lines.append('Opcodes: ' + ', '.join('%s %i' % (name, count) for name, count in data['opcodes'].items() if count))
+        lines.append('OR short-circuit %i/%i (%.1f%%), JF skip %i/%i (%.1f%%)' % (
+            data['or_taken'], data['or_tests'], data['or_hit_rate'] * 100,
+            data['jf_taken'], data['jf_tests'], data['jf_hit_rate'] * 100))
+        if data['cse_programs']:
+            lines.append('Subexpression sharing saved %i instructions in %i programs' % (
+                data['cse_saved'], data['cse_programs']))
+        cache = data['parse_cache']
+        lines.append('Parse cache: %i hits, %i misses, %i/%i equations' % (
+            cache['hits'], cache['misses'], cache['size'], cache['maxsize']))
+        return '\n'.join(lines)
+
+# Counters, updated while PROFILING is True
+STATS = Stats()
+PROFILING = False
+
+def enable_stats():
+    """ Start profiling, returns STATS. The counters keep their values, see Stats.reset(). """
+    global PROFILING
+    PROFILING = True
+    SOPCode.eval = SOPCode._eval_profiled
+    SOPCode.table = SOPCode._table_profiled
+    return STATS
+
+def disable_stats():
+    """ Stop profiling, the counters keep their values. """
+    global PROFILING
+    PROFILING = False
+    SOPCode.eval = SOPCode._eval_fast
+    SOPCode.table = SOPCode._table_fast
+
+def _count_ops(code, inputs, stats):
+    """ Run the bytecode like SOPCode.interpret() and add what it executed to stats. """
+    counts = [0] * len(OP_NAMES)
+    or_taken = jf_taken = 0
+    codelen = len(code)
+    v = True
+    depth = max_depth = 0
+    stack = []
+    temps = {}
+    pos = 0
+    while pos < codelen:
+        op, arg = code[pos], code[pos + 1]
+        counts[op] += 1
+        if op == OP_AND:
+            v &= inputs[arg]
+        elif op == OP_NAND:
+            v &= not inputs[arg]
+        elif op == OP_OR:
+            if v:
+                or_taken += 1
+                pos += 2 * arg
+                continue
+            v = True
+        elif op == OP_PUSH:
+            stack.append(v)
+            v = True
+            depth += 1
+            if depth > max_depth:
+                max_depth = depth
+        elif op == OP_JF:
+            if not v:
+                jf_taken += 1
+                pos += 2 * arg
+                continue
+        elif op == OP_POP:
+            v = stack.pop() and (v ^ arg)
+            depth -= 1
+        elif op == OP_LOAD:
+            v &= temps[arg]
+        elif op == OP_LOADN:
+            v &= not temps[arg]
+        elif op == OP_STORE:
+            temps[arg] = v
+            v = True
+        else:
+            v = True
+        pos += 2
+    stats.evals += 1
+    for name, count in zip(OP_NAMES, counts):
+        stats.opcodes[name] += count
+    stats.or_tests += counts[OP_OR]
+    stats.or_taken += or_taken
+    stats.jf_tests += counts[OP_JF]
+    stats.jf_taken += jf_taken
+    if max_depth > stats.max_depth:
+        stats.max_depth = max_depth
+
+#########################################################################################
+# Two-level minimization. Works on the truth table of each output, a cube (product term)
+# is a pair of bit masks (care, value): input j appears in the cube if bit j of care is
+# set, uninverted if bit j of value is set too.
+#########################################################################################
+
+# Largest number of inputs minimize() accepts, the truth table has 2**n bits
+MINIMIZE_MAX_VARS = 20
+# Largest number of inputs minimize() solves exactly in 'auto' mode
+EXACT_MAX_VARS = 8
+
+def _cube_rows(cube, masks, full):
+    """ Returns the truth table rows covered by cube as a bit mask. """
+    care, value = cube
+    rows = full
+    for j, mask in enumerate(masks):
+        if (care >> j) & 1:
+            rows &= mask if (value >> j) & 1 else mask ^ full
+    return rows
+
+def _prime_implicants(table, nvars):
+    """ Quine-McCluskey: generate every prime implicant of the function from its minterms. """
+    care = (1 << nvars) - 1
+    current = set((care, row) for row in range(1 << nvars) if (table >> row) & 1)
+    primes = []
+    while current:
+        merged = set()
+        combined = set()
+        for cube in current:
+            care, value = cube
+            for j in range(nvars):
+                bit = 1 << j
+                if care & bit and (care, value ^ bit) in current:
+                    merged.add((care & ~bit, value & ~bit))
+                    combined.add(cube)
+        primes.extend(current - combined)
+        current = merged
+    return primes
+
+def _exact_cover(table, primes, masks, full):
+    """ Find a cover of table with the fewest cubes (then literals) by branch and bound. """
+    covers = [(prime, _cube_rows(prime, masks, full)) for prime in primes]
+    best = [None, None]
+
+    def cost(chosen):
+        return (len(chosen), sum(bin(care).count('1') for care, _ in chosen))
+
+    def search(uncovered, chosen):
+        if not uncovered:
+            if best[0] is None or cost(chosen) < best[1]:
+                best[0] = list(chosen)
+                best[1] = cost(chosen)
+            return
+        if best[0] is not None and len(chosen) + 1 > best[1][0]:
+            return
+        # Branch on the lowest uncovered row, trying the primes that cover the most first
+        low = uncovered & -uncovered
+        candidates = [(prime, rows) for prime, rows in covers if rows & low]
+        candidates.sort(key=lambda c: -bin(c[1] & uncovered).count('1'))
+        for prime, rows in candidates:
+            chosen.append(prime)
+            search(uncovered & ~rows, chosen)
+            chosen.pop()
+
+    # Essential primes are the only cover of some row, take them first
+    chosen = []
+    uncovered = table
+    for prime, rows in covers:
+        others = 0
+        for other, orows in covers:
+            if other is not prime:
+                others |= orows
+        if rows & table & ~others:
+            chosen.append(prime)
+            uncovered &= ~rows
+    search(uncovered, chosen)
+    return best[0]
+
+def _isop(lower, upper, var, masks, full, memo):
+    """
+    Minato-Morreale irredundant sum of products of any function between lower and upper.
+    Returns (cubes, rows covered by cubes). var is the highest input the functions may depend on.
+    """
+    if not lower:
+        return [], 0
+    if upper == full:
+        return [(0, 0)], full
+    key = (lower, upper)
+    if key in memo:
+        return memo[key]
+    # Find the highest input lower or upper depends on
+    while True:
+        mask = masks[var]
+        shift = 1 << var
+        l0 = lower & ~mask
+        l0 |= l0 << shift
+        l1 = lower & mask
+        l1 |= l1 >> shift
+        u0 = upper & ~mask
+        u0 |= u0 << shift
+        u1 = upper & mask
+        u1 |= u1 >> shift
+        if l0 != l1 or u0 != u1:
+            break
+        var -= 1
+    c0, r0 = _isop(l0 & ~u1, u0, var - 1, masks, full, memo)
+    c1, r1 = _isop(l1 & ~u0, u1, var - 1, masks, full, memo)
+    cs, rs = _isop((l0 & ~r0) | (l1 & ~r1), u0 & u1, var - 1, masks, full, memo)
+    bit = 1 << var
+    cubes = [(care | bit, value) for care, value in c0]
+    cubes += [(care | bit, value | bit) for care, value in c1]
+    cubes += cs
+    result = (cubes, (r0 & ~mask) | (r1 & mask) | rs)
+    memo[key] = result
+    return result
+
+def _heuristic_cover(table, nvars, masks, full):
+    """ Espresso style: start from the ISOP, expand every cube to a prime and drop redundant cubes. """
+    cubes, _ = _isop(table, table, nvars - 1, masks, full, {})
+    # EXPAND: drop every literal the cube doesn't need
+    expanded = []
+    for care, value in cubes:
+        for j in range(nvars):
+            bit = 1 << j
+            if care & bit and not _cube_rows((care & ~bit, value & ~bit), masks, full) & ~table:
+                care &= ~bit
+                value &= ~bit
+        if (care, value) not in expanded:
+            expanded.append((care, value))
+    # IRREDUNDANT: drop cubes covered by the others, smallest first
+    covers = [(cube, _cube_rows(cube, masks, full)) for cube in expanded]
+    covers.sort(key=lambda c: bin(c[1]).count('1'))
+    n = 0
+    while n < len(covers):
+        others = 0
+        for i, (_, rows) in enumerate(covers):
+            if i != n:
+                others |= rows
+        if not table & ~others:
+            del covers[n]
+        else:
+            n += 1
+    return [cube for cube, _ in covers]
+
+def constant_text(value, names):
+    """ Equation text of a constant output, written with the first input of the SymbolTable names. """
+    first = names[0]
+    if value:
+        return first + '+' + first + "'"
+    return names.join([first, first + "'"])
+
+def _cubes_text(cubes, names):
+    """ Convert a cover to equation text. names is the SymbolTable of the inputs. """
+    if not cubes:
+        return constant_text(False, names)
+    terms = []
+    for care, value in cubes:
+        if not care:
+            return constant_text(True, names)
+        literals = []
+        for j, name in enumerate(names):
+            if (care >> j) & 1:
+                literals.append(name if (value >> j) & 1 else name + "'")
+        terms.append(names.join(literals))
+    return '+'.join(terms)
+
+def minimize(sopcode, mode='auto'):
+    """
+    Compute a minimal (or near minimal) sum of products for every output of an equation.
+    Returns a new SOPCode with the same inputs.
+    :param sopcode: SOPCode to minimize
+    :param mode: 'exact' (Quine-McCluskey, slow for many inputs), 'heuristic' (Espresso style) or 'auto'
+        to use exact up to EXACT_MAX_VARS inputs
+    :throws ValueError: if the equation has more than MINIMIZE_MAX_VARS inputs
+    """
+    names = sopcode.inputs
+    nvars = len(names)
+    if nvars > MINIMIZE_MAX_VARS:
+        raise ValueError('Can\'t minimize equations with more than %i inputs' % MINIMIZE_MAX_VARS)
+    if mode == 'auto':
+        mode = 'exact' if nvars <= EXACT_MAX_VARS else 'heuristic'
+    masks = input_masks(nvars, nvars)
+    full = (1 << (1 << nvars)) - 1
+    equations = []
+    for table in sopcode.table():
+        if mode == 'exact':
+            cubes = _exact_cover(table, _prime_implicants(table, nvars), masks, full)
+        else:
+            cubes = _heuristic_cover(table, nvars, masks, full)
+        equations.append(_cubes_text(cubes, names))
+    return parse(str(names) + ':' + ';'.join(equations), long_names=names.long_names)
+
+def dumps(sopcode):
+    """
+    Serialize a SOPCode to bytes. The bytecode is stored little-endian.
+    :param sopcode: SOPCode to serialize
+    """
+    code = sopcode._code
+    if sys.byteorder == 'big':
+        code = array.array(code.typecode, code)
+        code.byteswap()
+    inputs = ' '.join(sopcode.inputs).encode('utf-8')
+    text = sopcode.text.encode('utf-8')
+    header = _SOP_HEADER.pack(SOP_MAGIC, SOP_VERSION, code.typecode.encode('ascii'),
+                              len(inputs), len(text), len(code))
+    return header + inputs + text + code.tobytes()
+
+def loads(data):
+    """
+    Deserialize a SOPCode from bytes created by dumps().
+    :throws ValueError: if data is not a serialized SOPCode
+    """
+    data = memoryview(data)
+    try:
+        magic, version, typecode, inputs_len, text_len, code_len = _SOP_HEADER.unpack_from(data)
+    except struct.error:
+        raise ValueError('Truncated SOPCode header')
+    if magic != SOP_MAGIC:
+        raise ValueError('Not a serialized SOPCode')
+    if version > SOP_VERSION:
+        raise ValueError('Serialized SOPCode version %i is newer than %i' % (version, SOP_VERSION))
+    pos = _SOP_HEADER.size
+    inputs = bytes(data[pos:pos + inputs_len]).decode('utf-8')
+    # Version 1 only had single letter names, not separated
+    inputs = inputs.split(' ') if version > 1 else list(inputs)
+    pos += inputs_len
+    text = bytes(data[pos:pos + text_len]).decode('utf-8')
+    pos += text_len
+    code = array.array(typecode.decode('ascii'))
+    code.frombytes(data[pos:pos + code_len * code.itemsize])
+    if len(code) != code_len:
+        raise ValueError('Truncated SOPCode bytecode')
+    if sys.byteorder == 'big':
+        code.byteswap()
+    return SOPCode(code, inputs, text)
+
+def dump(sopcode, fp):
+    """ Write a serialized SOPCode to the binary file fp. """
+    fp.write(dumps(sopcode))
+
+def load(fp):
+    """ Read a serialized SOPCode from the binary file fp. """
+    return loads(fp.read())
+
+def token_check(text, long_names=False):
     """ Throw a parse error if an invalid token is in text. """
-    bad_match = INV_TOKEN_REGEX.search(text)
+    bad_match = (LONG_INV_TOKEN_REGEX if long_names else INV_TOKEN_REGEX).search(text)
     if bad_match:
         raise ParseError('Invalid token \'%s\' at index %i' % (bad_match[0], bad_match.start(0)))
 
-def parse(text, inputs=None):
+class ParseCache:
+    """
+    Bounded LRU cache of compiled equations keyed on (normalized text, inputs, opt, long_names, cse).
+    SOPCode objects are never modified once compiled so they can be shared by every caller.
+    """
+    def __init__(self, maxsize=PARSE_CACHE_SIZE):
+        """
+        Initialize a ParseCache.
+        :param maxsize: maximum number of equations kept, the least recently used are evicted first
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, text, inputs=None, opt=True, long_names=None, cse=False):
+        """ Returns the SOPCode for text, compiling it if it's not cached. Same parameters as parse(). """
+        # Runs of whitespace are the same as one for the grammar
+        key = (' '.join(text.split()), inputs if inputs is None else tuple(inputs), opt, long_names, cse)
+        code = self._entries.get(key)
+        if code is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return code
+        self.misses += 1
+        code = self._entries[key] = _parse(text, inputs, opt, long_names, cse)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return code
+
+    def clear(self):
+        """ Remove every equation and reset the statistics. """
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        """ Returns the statistics as a dict. """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'maxsize': self.maxsize}
+
+# Cache used by parse()
+PARSE_CACHE = ParseCache()
+
+def parse(text, inputs=None, opt=True, cache=True, long_names=None, cse=False):
     """
     Compile the given text, returns a SOPCode or raises a ParseError
-    :param text: Text to compile, if no prefix is supplied, inputs must be supplied
-    :param inputs: replacement for "prefix" if prefix is not part of "text", may be None
+    :param text: Text to compile
+    :param inputs: replacement for "prefix" if prefix is not part of "text", may be None. A string of
+        single letters or a list of names
+    :param opt: run the optimizer on the bytecode (see optimize())
+    :param cache: look the equation up in PARSE_CACHE first
+    :param long_names: allow names such as x17 or req_valid, names in a product must then be separated
+        by spaces ("x1 x2' + req_valid"). None to decide with uses_long_names(), so names of letters only
+        ("ready ack") are read as single letters unless this is True
+    :param cse: compute the product terms and groups shared by several outputs only once (see
+        eliminate_common())
     """
-    token_check(text)
-    opcodes = _compile(text, inputs)
-    inputs = get_variables(text)
-    return SOPCode(opcodes, inputs, text)
+    if cache:
+        return PARSE_CACHE.get(text, inputs, opt, long_names, cse)
+    return _parse(text, inputs, opt, long_names, cse)
+
+def _parse(text, inputs, opt, long_names, cse):
+    """ Compile the given text, see parse(). """
+    if long_names is None:
+        long_names = uses_long_names(text, inputs)
+    if long_names and isinstance(inputs, str):
+        inputs = inputs.split()
+    code, inputs = _compile(text, inputs, long_names)
+    if opt:
+        start = time.perf_counter() if PROFILING else 0
+        code, _ = optimize(code)
+        if PROFILING:
+            STATS.add_time('optimize', time.perf_counter() - start)
+    if cse:
+        start = time.perf_counter() if PROFILING else 0
+        code, saved = eliminate_common(code)
+        STATS.cse_programs += 1
+        STATS.cse_saved += saved
+        if PROFILING:
+            STATS.add_time('cse', time.perf_counter() - start)
+    return SOPCode(code, inputs, text)
 
 def get_variables(text):
     """
-    Returns a string of the names of the variables the equation uses in order.
+    Returns the SymbolTable of the variables the equation uses in order.
     :param text: Equation string to extract variables from.
     :throws ParseError: if text is not a valid equation
     """
-    token_check(text)
-    try:
-        # We don't need a real prefix, but it does need to exist
-        if ":" not in text:
-            text = ':' + text
-        return TransGetVariables().transform(sop_parser.parse(text))
-    except lark.common.ParseError as e:
-        raise e
+    return parse(text).inputs
+
+def _bench_compile(sizes=(1000, 10000, 100000), depths=(100, 1000, 10000)):
+    """ Scaling benchmark for parse(), the time per term should stay flat if compiling is linear. """
+    import random
+    import time
+
+    rand = random.Random(0)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    for terms in sizes:
+        text = '+'.join(''.join(rand.choice((v, v + "'")) for v in rand.sample(letters, 3)) for _ in range(terms))
+        start = time.perf_counter()
+        parse(text, cache=False)
+        elapsed = time.perf_counter() - start
+        print('%7i terms: %8.3f s  %6.2f us/term' % (terms, elapsed, elapsed / terms * 1e6))
+    for depth in depths:
+        text = 'a' + '(b+' * depth + 'c' + ')' * depth
+        start = time.perf_counter()
+        parse(text, cache=False)
+        elapsed = time.perf_counter() - start
+        print('%7i deep:  %8.3f s  %6.2f us/level' % (depth, elapsed, elapsed / depth * 1e6))
 
 if __name__ == '__main__':
-    _test_compile()
+    if sys.argv[1:] == ['bench']:
+        _bench_compile()
+    else:
+        _test_compile()
+        _test_eval()
+        _test_minimize()